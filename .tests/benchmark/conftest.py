@@ -0,0 +1,76 @@
+"""
+Configuration of the benchmarks of the workflow scripts. The sizes of the
+synthetic data are given as comma-separated lists in the command line, and
+each benchmark is run for all of them, e.g.:
+
+    python -m pytest .tests/benchmark/ --bench-sources 1000,1000000 \
+        --bench-pixels 256,1024 --bench-channels 100
+"""
+
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] /
+                       "workflow" / "scripts"))
+
+import synthetic
+
+OPTIONS = {
+    "sources": ("1000", "Number of sources of the synthetic catalogs"),
+    "pixels": ("256", "Number of pixels of the side of the synthetic cubes"),
+    "channels": ("64", "Number of channels of the synthetic cubes"),
+    "subcubes": ("9", "Number of subcubes of the grid"),
+}
+
+
+def pytest_addoption(parser):
+    for name, (default, help_text) in OPTIONS.items():
+        parser.addoption(f"--bench-{name}", default=default,
+                         help=f"{help_text}. Comma-separated list")
+    parser.addoption("--bench-rounds", default=3, type=int,
+                     help="Number of rounds of each benchmark")
+
+
+def pytest_generate_tests(metafunc):
+    """Runs each benchmark for all the sizes given in the command line"""
+    for name in OPTIONS:
+        fixture = f"n_{name}"
+        if fixture in metafunc.fixturenames:
+            values = [int(float(value)) for value in
+                      metafunc.config.getoption(f"bench_{name}").split(",")]
+            metafunc.parametrize(fixture, values, scope="session")
+
+
+@pytest.fixture
+def measure(benchmark, request):
+    """Times a function with pytest-benchmark, and records the peak memory
+    allocated by one extra call in `extra_info`"""
+    rounds = request.config.getoption("bench_rounds")
+
+    def run(func, *args, setup=None, **kwargs):
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        benchmark.extra_info["peak_memory_mb"] = peak/2**20
+        if setup is None:
+            return benchmark.pedantic(func, args=args, kwargs=kwargs,
+                                      rounds=rounds, iterations=1)
+        return benchmark.pedantic(lambda: func(*args, **kwargs),
+                                  setup=setup, rounds=rounds)
+    return run
+
+
+@pytest.fixture(scope="session")
+def cube_file(tmp_path_factory, n_pixels, n_channels):
+    """Synthetic data cube, generated once per size"""
+    directory = tmp_path_factory.mktemp(f"cube_{n_pixels}_{n_channels}")
+    return synthetic.write_cube(directory / "cube.fits", n_pixels,
+                                n_channels)
@@ -0,0 +1,116 @@
+"""
+Generators of synthetic data cubes and catalogs for the benchmarks of the
+workflow scripts. They follow the format of the SDC2 cubes and of the
+catalogs produced by Sofia and by the workflow, with sizes chosen at will.
+"""
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+
+# SDC2 cube: 2.8 arcsec pixels, 30 kHz channels from 950 MHz, 7 arcsec beam
+PIXEL_DEG = 2.8/3600
+CHANNEL_HZ = 3e4
+FREQ0_HZ = 9.5e8
+BEAM_DEG = 7/3600
+# Sources per square degree in the SDC2 truth catalog
+SOURCE_DENSITY = 1.2e4
+CATALOG_COLUMNS = ['id_subcube', 'ra', 'dec', 'hi_size',
+                   'line_flux_integral', 'central_freq', 'pa', 'i', 'w20',
+                   'rms', 'subcube']
+
+
+def cube_header(n_pix, n_chan):
+    """Header of a data cube of n_pix x n_pix pixels and n_chan channels"""
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    header['NAXIS1'] = n_pix
+    header['NAXIS2'] = n_pix
+    header['NAXIS3'] = n_chan
+    header['CTYPE1'] = 'RA---SIN'
+    header['CRVAL1'] = 0.0
+    header['CDELT1'] = -PIXEL_DEG
+    header['CRPIX1'] = n_pix/2 + 1
+    header['CUNIT1'] = 'deg'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRVAL2'] = -30.0
+    header['CDELT2'] = PIXEL_DEG
+    header['CRPIX2'] = n_pix/2 + 1
+    header['CUNIT2'] = 'deg'
+    header['CTYPE3'] = 'FREQ'
+    header['CRVAL3'] = FREQ0_HZ
+    header['CDELT3'] = CHANNEL_HZ
+    header['CRPIX3'] = 1.0
+    header['CUNIT3'] = 'Hz'
+    header['BMAJ'] = BEAM_DEG
+    header['BMIN'] = BEAM_DEG
+    header['BUNIT'] = 'Jy/beam'
+    header['RADESYS'] = 'ICRS'
+    header['SPECSYS'] = 'TOPOCENT'
+    return header
+
+
+def write_cube(filename, n_pix, n_chan, slab=16, seed=0):
+    """Writes a cube of gaussian noise, one slab of channels at a time, so
+    that cubes larger than the memory can be generated"""
+    rng = np.random.default_rng(seed)
+    stream = fits.StreamingHDU(str(filename), cube_header(n_pix, n_chan))
+    for k_0 in range(0, n_chan, slab):
+        n_planes = min(slab, n_chan - k_0)
+        stream.write(rng.normal(0, 1e-5, (n_planes, n_pix, n_pix))
+                     .astype('>f4'))
+    stream.close()
+    return filename
+
+
+def sofia_catalog(n_sources, n_pix, n_chan, seed=0):
+    """Raw Sofia catalog with the columns converted by sofia2cat"""
+    rng = np.random.default_rng(seed)
+    ell_maj = rng.uniform(2, 10, n_sources)
+    return pd.DataFrame({
+        'id': np.arange(1, n_sources + 1),
+        'x': rng.uniform(0, n_pix - 1, n_sources),
+        'y': rng.uniform(0, n_pix - 1, n_sources),
+        'z': rng.uniform(0, n_chan - 1, n_sources),
+        'ell_maj': ell_maj,
+        'ell_min': ell_maj*rng.uniform(0.2, 1, n_sources),
+        'f_sum': rng.lognormal(-2, 1, n_sources),
+        'freq': FREQ0_HZ + rng.uniform(0, n_chan - 1, n_sources)*CHANNEL_HZ,
+        'w20': rng.uniform(5, 30, n_sources),
+        'kin_pa': rng.uniform(0, 360, n_sources),
+        'rms': rng.uniform(1e-5, 2e-5, n_sources)})
+
+
+def sdc2_catalog(n_sources, n_chan, duplicates=0.05, seed=0):
+    """Concatenated catalog of the subcubes, in which a fraction of the
+    sources is detected again in a neighbouring subcube, with positions and
+    frequencies that differ slightly. The sources cover the sky area that
+    gives the density of sources of SDC2"""
+    rng = np.random.default_rng(seed)
+    n_unique = int(round(n_sources/(1 + duplicates)))
+    half_size = np.sqrt(n_sources/SOURCE_DENSITY)/2
+    cat = pd.DataFrame({
+        'id_subcube': np.arange(n_unique),
+        'ra': rng.uniform(-half_size, half_size, n_unique) % 360,
+        'dec': -30 + rng.uniform(-half_size, half_size, n_unique),
+        'hi_size': rng.uniform(5, 30, n_unique),
+        'line_flux_integral': rng.lognormal(3, 1, n_unique),
+        'central_freq': FREQ0_HZ + rng.uniform(0, n_chan - 1,
+                                               n_unique)*CHANNEL_HZ,
+        'pa': rng.uniform(0, 360, n_unique),
+        'i': rng.uniform(0, 90, n_unique),
+        'w20': rng.uniform(50, 400, n_unique),
+        'rms': rng.uniform(1e-5, 2e-5, n_unique),
+        'subcube': np.zeros(n_unique, dtype=int)})
+    copies = cat.sample(n_sources - n_unique, replace=True, random_state=seed)
+    copies = copies.assign(
+        ra=copies['ra'] + rng.normal(0, 0.3/3600, len(copies)),
+        dec=copies['dec'] + rng.normal(0, 0.3/3600, len(copies)),
+        central_freq=copies['central_freq'] + rng.normal(0, 1e5, len(copies)),
+        rms=rng.uniform(1e-5, 2e-5, len(copies)),
+        subcube=1)
+    return Table.from_pandas(pd.concat([cat, copies], ignore_index=True)
+                             [CATALOG_COLUMNS])
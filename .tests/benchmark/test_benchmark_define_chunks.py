@@ -0,0 +1,18 @@
+"""Benchmark of the definition of the grid of subcubes"""
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import define_chunks
+
+
+def define_grid(cube_file, num_subcubes, coord_file, resources_file):
+    wcs = WCS(fits.getheader(cube_file))
+    ranges = define_chunks.regular_ranges(wcs.array_shape[1], num_subcubes)
+    define_chunks.define_grid(wcs, ranges, ranges, 40, 1, 0, coord_file,
+                              resources_file=resources_file)
+
+
+def test_define_chunks(measure, cube_file, n_subcubes, tmp_path):
+    measure(define_grid, cube_file, n_subcubes, tmp_path / "coord.csv",
+            tmp_path / "resources.csv")
@@ -0,0 +1,22 @@
+"""Benchmark of the removal of duplicated sources"""
+
+import pytest
+
+import eliminate_duplicates
+import synthetic
+
+
+@pytest.fixture
+def catalog_table(n_sources, n_channels):
+    return synthetic.sdc2_catalog(n_sources, n_channels)
+
+
+def eliminate(catalog_table):
+    ras, dec, freq = eliminate_duplicates.read_coordinates_from_table(
+        catalog_table)
+    pairs = eliminate_duplicates.find_catalog_duplicates(ras, dec, freq)
+    return eliminate_duplicates.mask_worse_duplicates(pairs, catalog_table)
+
+
+def test_eliminate_duplicates(measure, catalog_table):
+    measure(eliminate, catalog_table)
@@ -0,0 +1,15 @@
+"""Benchmark of the computation of HI masses and diameters"""
+
+import pytest
+
+import filter_catalog
+import synthetic
+
+
+@pytest.fixture
+def catalog(n_sources, n_channels):
+    return synthetic.sdc2_catalog(n_sources, n_channels).to_pandas()
+
+
+def test_compute_d_m(measure, catalog):
+    measure(filter_catalog.compute_d_m, catalog)
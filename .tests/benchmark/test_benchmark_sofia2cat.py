@@ -0,0 +1,20 @@
+"""Benchmark of the conversion of Sofia catalogs"""
+
+import pytest
+
+import sofia2cat
+import synthetic
+from split_subcube import write_header
+
+
+@pytest.fixture
+def raw_catalog(n_sources, n_pixels, n_channels):
+    return synthetic.sofia_catalog(n_sources, n_pixels, n_channels)
+
+
+def test_process_catalog(measure, raw_catalog, n_pixels, n_channels,
+                         tmp_path):
+    fitsfile = str(tmp_path / "subcube_0.fits")
+    write_header(synthetic.cube_header(n_pixels, n_channels), fitsfile)
+    measure(sofia2cat.process_catalog, raw_catalog,
+            sofia2cat.find_header(fitsfile), subcube="0")
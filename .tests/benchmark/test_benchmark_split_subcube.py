@@ -0,0 +1,31 @@
+"""Benchmark of the extraction of the subcubes from the data cube"""
+
+import numpy as np
+import pytest
+
+import split_subcube
+from test_benchmark_define_chunks import define_grid
+
+
+@pytest.fixture
+def coord_subcubes(cube_file, n_subcubes, tmp_path, monkeypatch):
+    """Grid of subcubes, with the subcubes written to the temporary
+    directory"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "interim" / "subcubes").mkdir(parents=True)
+    define_grid(cube_file, n_subcubes, "coord.csv", "resources.csv")
+    return split_subcube.read_coord_file("coord.csv")
+
+
+def split_each(cube_file, coord_subcubes):
+    for idx in range(len(coord_subcubes)):
+        split_subcube.split_subcube(cube_file, coord_subcubes, idx)
+
+
+def test_split_subcube(measure, cube_file, coord_subcubes):
+    measure(split_each, cube_file, coord_subcubes)
+
+
+def test_split_subcubes_batch(measure, cube_file, coord_subcubes):
+    measure(split_subcube.split_subcubes, cube_file, coord_subcubes,
+            list(np.arange(len(coord_subcubes))))
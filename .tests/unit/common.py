@@ -33,6 +33,7 @@ class OutputChecker:
                     or str(f).startswith("workflow")
                     or str(f).startswith("config")
                     or str(f).startswith("results/logs/")
+                    or str(f).startswith("results/benchmarks/")
                     or (str(f).startswith("results/sofia/") and '_cat.txt' not in (str(f)))
                     or ".DB" in str(f)
                     or str(f).endswith(".html")
@@ -7,8 +7,24 @@ import shutil
 from pathlib import Path, PurePosixPath
 
 sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+import pandas as pd
 
 import common
+from catalog_io import CATALOG_COLUMNS, read_catalog
+from concatenate_catalogs import concatenate_catalogs
+
+
+class CatalogChecker(common.OutputChecker):
+    # Parquet files store the version of the library that wrote them, so the
+    # tables are compared instead of the bytes
+    def compare_files(self, generated_file, expected_file):
+        if str(expected_file).endswith(".parquet"):
+            pd.testing.assert_frame_equal(read_catalog(str(generated_file)),
+                                          read_catalog(str(expected_file)))
+        else:
+            super().compare_files(generated_file, expected_file)
 
 
 def test_concatenate_catalogs():
@@ -52,3 +68,54 @@ def test_concatenate_catalogs():
         # and overwrite the method `compare_files(generated_file, expected_file), 
         # also see common.py.
         common.OutputChecker(data_path, expected_path, workdir).check()
+
+
+def test_concatenate_parquet_catalogs():
+
+    with TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir) / "workdir"
+        data_path = PurePosixPath(".tests/unit/concatenate_catalogs_parquet/data")
+        expected_path = PurePosixPath(".tests/unit/concatenate_catalogs_parquet/expected")
+        config_path = PurePosixPath(".tests/unit/config")
+        workflow_path = PurePosixPath(".tests/unit/workflow")
+
+        # Copy data to the temporary workdir.
+        shutil.copytree(data_path, workdir)
+        shutil.copytree(config_path, workdir / "config")
+        shutil.copytree(workflow_path, workdir / "workflow")
+
+        # dbg
+        print("results/catalogs/catalog_w_duplicates.parquet", file=sys.stderr)
+
+        # Run the test job. The catalog of subcube 1 is empty
+        sp.check_output([
+            "python",
+            "-m",
+            "snakemake",
+            "results/catalogs/catalog_w_duplicates.parquet",
+            "-j1",
+            "--keep-target-files",
+            "--use-conda",
+            "--conda-frontend","mamba",
+            "--config","incube='interim/sofia_test_datacube.fits'",
+            "subcube_id=[0,1]",
+            "num_subcubes=16",
+            "pixel_overlap=0",
+            "catalog_format=parquet",
+            "--directory",
+            workdir,
+        ])
+
+        CatalogChecker(data_path, expected_path, workdir).check()
+
+
+def test_concatenate_empty_parquet_catalogs():
+
+    empty_catalog = ".tests/unit/concatenate_catalogs_parquet/data/results/sofia/1/subcube_1_final_catalog.parquet"
+    with TemporaryDirectory() as tmpdir:
+        for infiles in [[], [empty_catalog]]:
+            outfile = str(Path(tmpdir) / "catalog_w_duplicates.parquet")
+            concatenate_catalogs(infiles, outfile)
+            cat = read_catalog(outfile)
+            assert list(cat.columns) == CATALOG_COLUMNS
+            assert len(cat) == 0
@@ -0,0 +1,71 @@
+import os
+import sys
+
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import vstack
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+import deduplicate_subcube
+from catalog_io import CATALOG_COLUMNS
+from eliminate_duplicates import read_ref_catalog, \
+        read_coordinates_from_table, find_catalog_duplicates, \
+        mask_worse_duplicates
+
+DATACUBE = Path(os.path.dirname(__file__)) / "sofia2cat/data/interim/subcubes/subcube_0.fits"
+
+
+def write_catalog(filename, wcs, subcube, sources):
+    # Sources given as (x, y, rms) in pixels of the data cube
+    x, y, rms = np.array(sources, dtype=float).T
+    ra, dec = wcs.all_pix2world(x, y, 0)
+    with open(filename, "w") as outfile:
+        outfile.write(" ".join(CATALOG_COLUMNS) + "\n")
+        for k in range(len(x)):
+            outfile.write(f"{k + 1} {ra[k]!r} {dec[k]!r} 10.0 1.0 1415000000.0 "
+                          f"0.0 45.0 100.0 {rms[k]} {subcube}\n")
+
+
+def test_deduplicate_subcube():
+
+    wcs = WCS(fits.getheader(DATACUBE)).celestial
+    with TemporaryDirectory() as tmpdir:
+        coord_file = Path(tmpdir) / "coord_subcubes.csv"
+        coord_file.write_text(
+            "xlo,ylo,xhi,yhi,zlo,zhi,x0,x1,y0,y1,z0,z1\n"
+            "0,0,0,0,1.4e9,1.43e9,0,30,0,50,0,100\n"
+            "0,0,0,0,1.4e9,1.43e9,20,50,0,50,0,100\n")
+        catalogs = [Path(tmpdir) / f"subcube_{idx}_final_catalog.csv"
+                    for idx in range(2)]
+        # Pixels are 10 arcsec, duplicates are closer than 0.3 pixels
+        write_catalog(catalogs[0], wcs, 0, [
+            (5, 5, 1.0),      # outside the overlap
+            (25, 10, 2.0),    # duplicate of a better source of subcube 1
+            (28, 40, 1.0),    # duplicate of a worse source of subcube 1
+            (29, 30, 2.0),    # chain of duplicates leaving the strip
+        ])
+        write_catalog(catalogs[1], wcs, 1, [
+            (25.1, 10, 1.0),
+            (28.1, 40, 2.0),
+            (29.25, 30, 3.0),
+            (29.5, 30, 3.0),
+            (29.75, 30, 0.5),
+            (45, 45, 1.0),    # outside the overlap
+        ])
+
+        keep = deduplicate_subcube.deduplicate_subcube(
+            str(catalogs[0]), [str(catalogs[1])], str(DATACUBE),
+            str(coord_file), 0)
+        assert keep.tolist() == [True, False, True, False]
+
+        # Same result as the matching of the full catalog
+        full_table = vstack([read_ref_catalog(str(catalog), CATALOG_COLUMNS)
+                             for catalog in catalogs])
+        pairs = find_catalog_duplicates(*read_coordinates_from_table(full_table))
+        duplicates = mask_worse_duplicates(pairs, full_table)
+        assert keep.tolist() == (~duplicates[:4]).tolist()
@@ -7,8 +7,18 @@ import shutil
 from pathlib import Path, PurePosixPath
 
 sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
 
 import common
+from define_chunks import define_slabs, define_spectral_bounds, \
+        check_channel_overlap
+from eliminate_duplicates import restrict_to_spectral_overlap
 
 
 def test_define_chunks():
@@ -54,3 +64,39 @@ def test_define_chunks():
         # and overwrite the method `compare_files(generated_file, expected_file), 
         # also see common.py.
         common.OutputChecker(data_path, expected_path, workdir).check()
+
+
+def test_spectral_bounds():
+
+    # The test cube has an optical velocity axis in m/s
+    header = fits.getheader(Path(os.path.dirname(__file__)) / "sofia2cat/data/interim/subcubes/subcube_0.fits")
+    wcs = WCS(header)
+    bounds = define_spectral_bounds(wcs, define_slabs(100, 2, 10))
+    velocity = wcs.spectral.pixel_to_world_values(np.array([0, 54, 45, 99]))
+    assert np.allclose(bounds.ravel(), header['RESTFRQ']/(1 + velocity/299792458.))
+
+    # Frequency axis in MHz, with slabs wider than the frequency tolerance
+    header['CTYPE3'] = 'FREQ'
+    header['CUNIT3'] = 'MHz'
+    header['CRVAL3'] = 1400.
+    header['CDELT3'] = 1.
+    header['CRPIX3'] = 1.
+    bounds = define_spectral_bounds(WCS(header), define_slabs(100, 2, 10))
+    assert np.allclose(bounds, [[1400e6, 1454e6], [1445e6, 1499e6]])
+
+    # A pair in the overlap of the slabs is kept, and a pair more than 20 MHz
+    # below the second slab is not
+    coord_subcubes = np.rec.fromarrays(bounds.T, names=['zlo', 'zhi'])
+    catalog = Table({'subcube': [0, 1, 0, 1],
+                     'central_freq': [1450e6, 1450.1e6, 1410e6, 1410.1e6]})
+    pairs = np.array([[0, 1], [2, 3]])
+    assert restrict_to_spectral_overlap(pairs, catalog, coord_subcubes).tolist() == [[0, 1]]
+
+
+def test_check_channel_overlap():
+
+    # Largest kernelsZ of 41 channels plus 2*linker.radiusZ of 5 channels
+    parfile = os.path.join(os.path.dirname(__file__), "config", "sofia_12.par")
+    check_channel_overlap(51, parfile)
+    with pytest.raises(ValueError):
+        check_channel_overlap(0, parfile)
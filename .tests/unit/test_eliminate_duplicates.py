@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+from eliminate_duplicates import find_catalog_duplicates, mask_worse_duplicates
+
+
+def random_catalog(n_sources, seed):
+    # Clusters of sources closer than the tolerances, with ties in rms
+    rng = np.random.default_rng(seed)
+    centres = rng.integers(0, n_sources//3, n_sources)
+    ra = 180 + centres*1e-3 + rng.normal(0, 1.5, n_sources)/3600
+    dec = 60 + centres*1e-3 + rng.normal(0, 1.5, n_sources)/3600
+    freq = 1.4e9 + centres*1e5 + rng.normal(0, 1.2e7, n_sources)
+    return Table({'ra': ra, 'dec': dec, 'central_freq': freq,
+                  'rms': rng.integers(1, 4, n_sources)*1e-4,
+                  'subcube': rng.integers(0, 4, n_sources),
+                  'id_subcube': np.arange(n_sources)})
+
+
+def brute_force_pairs(cat, max_sep=3*u.arcsec, max_freq=20*u.MHz):
+    coord = SkyCoord(ra=cat['ra']*u.degree, dec=cat['dec']*u.degree)
+    freq = np.asarray(cat['central_freq'])
+    pairs = []
+    for i in range(len(cat)):
+        sep = coord[i].separation(coord[i + 1:])
+        close = (sep < max_sep) & \
+                (np.abs(freq[i + 1:] - freq[i]) < max_freq.to_value(u.Hz))
+        pairs += [(i, i + 1 + j) for j in np.where(close)[0]]
+    return np.array(pairs, dtype=int).reshape(-1, 2)
+
+
+def brute_force_duplicates(pairs, cat):
+    # Merge the groups pair by pair, and keep the best source of each group
+    group = list(range(len(cat)))
+    for i, j in pairs:
+        old, new = group[j], group[i]
+        group = [new if g == old else g for g in group]
+    duplicates = np.ones(len(cat), dtype=bool)
+    for label in set(group):
+        members = [k for k in range(len(cat)) if group[k] == label]
+        best = min(members, key=lambda k: (cat['rms'][k], cat['subcube'][k],
+                                           cat['id_subcube'][k]))
+        duplicates[best] = False
+    return duplicates
+
+
+def test_find_catalog_duplicates():
+
+    for seed in range(5):
+        cat = random_catalog(300, seed)
+        pairs = find_catalog_duplicates(cat['ra']*u.degree, cat['dec']*u.degree,
+                                        cat['central_freq']*u.Hz)
+        expected = brute_force_pairs(cat)
+        assert len(expected) > 0
+        assert pairs.tolist() == expected.tolist()
+        assert mask_worse_duplicates(pairs, cat).tolist() == \
+            brute_force_duplicates(expected, cat).tolist()
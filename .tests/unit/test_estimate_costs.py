@@ -0,0 +1,58 @@
+import os
+import sys
+
+import subprocess as sp
+from tempfile import TemporaryDirectory
+import shutil
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import common
+
+
+def test_estimate_costs():
+
+    with TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir) / "workdir"
+        data_path = PurePosixPath(".tests/unit/estimate_costs/data")
+        expected_path = PurePosixPath(".tests/unit/estimate_costs/expected")
+        config_path = PurePosixPath(".tests/unit/config")
+        workflow_path = PurePosixPath(".tests/unit/workflow")
+
+        # Copy data to the temporary workdir.
+        shutil.copytree(data_path, workdir)
+        shutil.copytree(config_path, workdir / "config")
+        shutil.copytree(workflow_path, workdir / "workflow")
+
+        # dbg
+        print("results/catalogs/chunk_costs.csv", file=sys.stderr)
+
+        # Run the test job. The grid in the data is the one written by
+        # define_chunks for this cube, so only estimate_costs is run
+        sp.check_output([
+            "python",
+            "-m",
+            "snakemake", 
+            "results/catalogs/chunk_costs.csv",
+            "--allowed-rules","estimate_costs",
+#            "-F", 
+            "-j1",
+            "--keep-target-files",
+            "--use-conda",
+            "--conda-frontend","mamba",
+            "--config","incube='interim/subcubes/subcube_0.fits'",
+            "num_subcubes=4",
+            "pixel_overlap=10",
+            "load_balance=True",
+            "cost_stride=2",
+            "threads=4",
+            "--directory",
+            workdir,
+        ])
+
+        # Check the output byte by byte using cmp.
+        # To modify this behavior, you can inherit from common.OutputChecker in here
+        # and overwrite the method `compare_files(generated_file, expected_file), 
+        # also see common.py.
+        common.OutputChecker(data_path, expected_path, workdir).check()
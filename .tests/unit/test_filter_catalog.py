@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.cosmology import FlatLambdaCDM
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+from filter_catalog import arcsec2kpc, distance_table, DA_RTOL
+
+
+def test_arcsec2kpc():
+
+    cosmo = FlatLambdaCDM(H0=70, Om0=0.3)
+    redshift = np.random.default_rng(0).uniform(0, 0.5, 10000)
+    redshift[:2] = 0, 0.5
+    theta = np.full(redshift.shape, 3600.)
+    expected = np.radians(1)*cosmo.angular_diameter_distance(redshift).to_value(u.kpc)
+    kpc = arcsec2kpc(redshift, theta)
+    assert kpc[0] == 0
+    assert np.all(np.abs(kpc[1:]/expected[1:] - 1) <= DA_RTOL)
+
+    # Non-finite redshifts give NaN without changing the other sources
+    kpc = arcsec2kpc(np.array([0.3, np.nan, np.inf]), np.full(3, 3600.))
+    assert kpc[0] == pytest.approx(
+        np.radians(1)*cosmo.angular_diameter_distance(0.3).to_value(u.kpc), rel=DA_RTOL)
+    assert np.isnan(kpc[1:]).all()
+    assert np.isnan(arcsec2kpc(np.array([np.nan]), np.array([3600.]))).all()
+
+
+def test_distance_table_step():
+
+    with pytest.raises(ValueError):
+        distance_table(0., 0.5, z_step=0.25)
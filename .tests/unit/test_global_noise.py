@@ -0,0 +1,52 @@
+import os
+import sys
+
+import subprocess as sp
+from tempfile import TemporaryDirectory
+import shutil
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import common
+
+
+def test_global_noise():
+
+    with TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir) / "workdir"
+        data_path = PurePosixPath(".tests/unit/global_noise/data")
+        expected_path = PurePosixPath(".tests/unit/global_noise/expected")
+        config_path = PurePosixPath(".tests/unit/config")
+        workflow_path = PurePosixPath(".tests/unit/workflow")
+
+        # Copy data to the temporary workdir.
+        shutil.copytree(data_path, workdir)
+        shutil.copytree(config_path, workdir / "config")
+        shutil.copytree(workflow_path, workdir / "workflow")
+
+        # dbg
+        print("results/catalogs/channel_noise.csv", file=sys.stderr)
+
+        # Run the test job.
+        sp.check_output([
+            "python",
+            "-m",
+            "snakemake", 
+            "results/catalogs/channel_noise.csv",
+#            "-F", 
+            "-j1",
+            "--keep-target-files",
+            "--use-conda",
+            "--conda-frontend","mamba",
+            "--config","incube='interim/subcubes/subcube_0.fits'",
+            "global_noise=True",
+            "--directory",
+            workdir,
+        ])
+
+        # Check the output byte by byte using cmp.
+        # To modify this behavior, you can inherit from common.OutputChecker in here
+        # and overwrite the method `compare_files(generated_file, expected_file), 
+        # also see common.py.
+        common.OutputChecker(data_path, expected_path, workdir).check()
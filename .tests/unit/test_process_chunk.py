@@ -0,0 +1,60 @@
+import os
+import sys
+
+import subprocess as sp
+from tempfile import TemporaryDirectory
+import shutil
+from pathlib import Path, PurePosixPath
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import common
+
+
+def test_process_chunk():
+
+    with TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir) / "workdir"
+        data_path = PurePosixPath(".tests/unit/process_chunk/data")
+        expected_path = PurePosixPath(".tests/unit/process_chunk/expected")
+        config_path = PurePosixPath(".tests/unit/config/config.yaml")
+        workflow_path = PurePosixPath(".tests/unit/workflow")
+
+        # Copy data to the temporary workdir.
+        shutil.copytree(data_path, workdir)
+        shutil.copyfile(config_path, workdir / "config/config.yaml")
+        shutil.copytree(workflow_path, workdir / "workflow")
+
+        # dbg
+        print("results/sofia/0/subcube_0_final_catalog.csv", file=sys.stderr)
+
+        # Run the test job. The only subcube of the grid is the test subcube,
+        # so the catalog is the same as in test_run_sofia and test_sofia2cat
+        sp.check_output([
+            "python",
+            "-m",
+            "snakemake", 
+            "results/sofia/0/subcube_0_final_catalog.csv",
+            "--allowed-rules","process_chunk",
+            #"-F", 
+            "-j1",
+            "--keep-target-files",
+            "--use-conda",
+            "--conda-frontend","mamba",
+            "--config","incube='interim/subcubes/subcube_0.fits'",
+            "subcube_id=[0]",
+            "num_subcubes=1",
+            "pixel_overlap=0",
+            "sofia_param=config/dev12.par",
+            "stage_chunks=True",
+    
+            "--use-conda",
+            "--directory",
+            workdir,
+        ])
+
+        # Check the output byte by byte using cmp.
+        # To modify this behavior, you can inherit from common.OutputChecker in here
+        # and overwrite the method `compare_files(generated_file, expected_file), 
+        # also see common.py.
+        common.OutputChecker(data_path, expected_path, workdir).check()
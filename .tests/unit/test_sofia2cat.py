@@ -7,8 +7,12 @@ import shutil
 from pathlib import Path, PurePosixPath
 
 sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+import pandas as pd
 
 import common
+import sofia2cat
 
 
 def test_sofia2cat():
@@ -56,3 +60,14 @@ def test_sofia2cat():
         # and overwrite the method `compare_files(generated_file, expected_file), 
         # also see common.py.
         common.OutputChecker(data_path, expected_path, workdir).check()
+
+
+def test_sofia_catalog_formats():
+
+    # The XML catalog in the data of test_sofia2cat, which is read instead of
+    # the ASCII catalog, has the same sources and types
+    catalog = Path(os.path.dirname(__file__)) / "sofia2cat/data/results/sofia/0/subcube_0_cat"
+    ascii_cat = sofia2cat.read_sofia_ascii(f"{catalog}.txt")
+    xml_cat = sofia2cat.read_sofia_xml(f"{catalog}.xml")
+    assert ascii_cat['name'].tolist()[0] == "SoFiA J120416.89+615327.8"
+    pd.testing.assert_frame_equal(ascii_cat, xml_cat)
@@ -0,0 +1,109 @@
+import os
+import sys
+
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "workflow", "scripts"))
+
+import sofia_cache
+
+
+def write_files(root, files):
+    for name in files:
+        path = Path(root) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+
+
+def list_files(root):
+    return sorted(str(Path(path, f).relative_to(root))
+                  for path, subdirs, files in os.walk(root) for f in files)
+
+
+def test_sofia_cache_restores_sofia_products():
+
+    # Products of one execution of Sofia for subcube 0
+    sofia_files = [
+        "subcube_0_cat.txt",
+        "subcube_0_cat.xml",
+        "subcube_0_mom0.fits",
+        "subcube_0_cubelets/subcube_0_1_cube.fits",
+        "subcube_0_cubelets/subcube_0_1_spec.txt",
+    ]
+    # Files in the same directory that Sofia did not write in this execution
+    other_files = [
+        "sofia.par",
+        "subcube_0_final_catalog.csv",
+        "subcube_0_dedup_catalog.csv",
+        "sweep/s4.0_f6.0_r0.4/subcube_0_noise.fits",
+        "sweep/sweep_catalogs.csv",
+    ]
+
+    with TemporaryDirectory() as tmpdir:
+        output_path = Path(tmpdir) / "results/sofia/0"
+        cache_dir = Path(tmpdir) / "cache"
+        cache_dir.mkdir()
+        write_files(output_path, sofia_files + other_files)
+
+        sofia_cache.store(str(cache_dir), "key", str(output_path),
+                          "subcube_0", max_size=2**30)
+        assert list_files(cache_dir / "key") == sorted(sofia_files + ["manifest.json"])
+
+        # A hit for another subcube with the same contents restores exactly
+        # the products of the first execution, with the new name
+        restored_path = Path(tmpdir) / "results/sofia/3"
+        assert sofia_cache.restore(str(cache_dir), "key", str(restored_path),
+                                   "subcube_3")
+        assert list_files(restored_path) == sorted(
+            name.replace("subcube_0", "subcube_3") for name in sofia_files)
+        assert (restored_path / "subcube_3_cat.txt").read_text() == "subcube_0_cat.txt"
+
+        assert not sofia_cache.restore(str(cache_dir), "other", str(restored_path),
+                                       "subcube_3")
+
+
+def test_sofia_cache_key():
+
+    with TemporaryDirectory() as tmpdir:
+        datacube = Path(tmpdir) / "subcube_0.fits"
+        datacube.write_bytes(b"\0" * 100000)
+        parfiles = {}
+        for name, threads, threshold in [("a", 8, 4.0), ("b", 32, 4.0), ("c", 8, 4.5)]:
+            parfiles[name] = Path(tmpdir) / f"{name}.par"
+            parfiles[name].write_text(
+                f"input.data = {tmpdir}/{name}.fits\n"
+                f"pipeline.threads = {threads}\n"
+                f"scfind.threshold = {threshold}\n")
+        keys = {name: sofia_cache.cache_key(str(parfile), str(datacube), "2.3.0")
+                for name, parfile in parfiles.items()}
+        # Paths and threads do not change the results of Sofia
+        assert keys["a"] == keys["b"]
+        assert keys["a"] != keys["c"]
+        assert keys["a"] != sofia_cache.cache_key(str(parfiles["a"]), str(datacube), "2.4.0")
+        datacube.write_bytes(b"\1" + b"\0" * 99999)
+        assert keys["a"] != sofia_cache.cache_key(str(parfiles["a"]), str(datacube), "2.3.0")
+
+
+def test_sofia_cache_key_full_contents():
+
+    with TemporaryDirectory() as tmpdir:
+        datacube = Path(tmpdir) / "subcube_0.fits"
+        parfile = Path(tmpdir) / "sofia.par"
+        parfile.write_text("scfind.threshold = 4.0\n")
+        digest_dir = Path(tmpdir) / "cache" / "digests"
+        size = 65 * 2**16 + 12345
+        datacube.write_bytes(b"\0" * size)
+        key = sofia_cache.cache_key(str(parfile), str(datacube), "2.3.0",
+                                    str(digest_dir))
+        assert len(list(digest_dir.iterdir())) == 1
+        # The digest is read from the sidecar while the file does not change
+        assert key == sofia_cache.cache_key(str(parfile), str(datacube), "2.3.0",
+                                            str(digest_dir))
+        # A single byte changed in place, away from any sampled block
+        with open(datacube, "r+b") as outfile:
+            outfile.seek(size // 2 + 7)
+            outfile.write(b"\1")
+        assert key != sofia_cache.cache_key(str(parfile), str(datacube), "2.3.0",
+                                            str(digest_dir))
+        assert key != sofia_cache.cache_key(str(parfile), str(datacube), "2.3.0")
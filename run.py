@@ -72,6 +72,7 @@ def run_summary(command):
     os.system(command + " --rulegraph --forceall | dot -Tsvg > summary/rulegraph.svg")
     os.system(command + " --dag --forceall | dot -Tsvg > summary/dag.svg")
     os.system(command + " --filegraph --forceall | dot -Tsvg > summary/filegraph.svg")
+    os.system(command + " summary/performance.csv")
 
 def run_check():
     '''Executes the snakemake workflow in check mode'''
@@ -1,38 +1,123 @@
-rule define_chunks:
+checkpoint define_chunks:
     input:
-        config['incube']
+        config['incube'],
+        config['sofia_param']
     output:
         config['coord_file'],
-	config['grid_plot']
+        config['grid_plot'],
+        config['chunk_resources']
     conda:
         "../envs/chunk_data.yml"
     log:
         "results/logs/define_chunks/define_chunks.log"
+    benchmark:
+        "results/benchmarks/define_chunks/define_chunks.tsv"
     params:
         incube = config['incube'],
         grid_plot = config['grid_plot'],
         num_subcubes = config['num_subcubes'],
         pixel_overlap = config['pixel_overlap'],
-        coord_file = config['coord_file']
+        num_freq_slabs = config['num_freq_slabs'],
+        channel_overlap = config['channel_overlap'],
+        coord_file = config['coord_file'],
+        chunk_resources = config['chunk_resources'],
+        bytes_per_voxel = config['bytes_per_voxel'],
+        max_threads = config['threads'],
+        planner = f"--plan -m {config['mem_per_job_mb']} --cores {workflow.cores}" if config['chunk_planner'] else ""
     shell:
-        "python workflow/scripts/define_chunks.py -d {params.incube} -g {params.grid_plot} -n {params.num_subcubes} -o {params.pixel_overlap} -c {params.coord_file} | tee {log}"
+        "python workflow/scripts/define_chunks.py -d {params.incube} -g {params.grid_plot} -n {params.num_subcubes} -o {params.pixel_overlap} -z {params.num_freq_slabs} -v {params.channel_overlap} -c {params.coord_file} -r {params.chunk_resources} -b {params.bytes_per_voxel} --threads {params.max_threads} -p {input[1]} {params.planner} | tee {log}"
 
-rule split_subcube:
+checkpoint estimate_costs:
     input:
         config['incube'],
-        config['coord_file'],
-	config['grid_plot']
+        config['coord_file']
     output:
-        #temp("interim/subcubes/subcube_{idx}.fits")
-        "interim/subcubes/subcube_{idx}.fits"
+        config['chunk_costs']
+    conda:
+        "../envs/chunk_data.yml"
     log:
-        "results/logs/split_subcube/subcube_{idx}.log"
-    resources:
-        bigfile=1
+        "results/logs/estimate_costs/estimate_costs.log"
+    benchmark:
+        "results/benchmarks/estimate_costs/estimate_costs.tsv"
+    params:
+        incube = config['incube'],
+        coord_file = config['coord_file'],
+        stride = config['cost_stride'],
+        max_threads = config['threads'],
+        bytes_per_voxel = config['bytes_per_voxel']
+    shell:
+        "python workflow/scripts/estimate_costs.py -d {params.incube} -c {params.coord_file} -o {output} -s {params.stride} -t {params.max_threads} -b {params.bytes_per_voxel} | tee {log}"
+
+rule global_noise:
+    input:
+        config['incube'],
+        config['sofia_param']
+    output:
+        config['channel_noise'],
+        [interim("interim/noise_cube.fits")] if config['virtual_subcubes'] else []
     conda:
         "../envs/chunk_data.yml"
+    log:
+        "results/logs/global_noise/global_noise.log"
+    benchmark:
+        "results/benchmarks/global_noise/global_noise.tsv"
+    threads:
+        config['threads']
     params:
         incube = config['incube'],
-        coord_file = config['coord_file']
+        noise_cube = "-n interim/noise_cube.fits" if config['virtual_subcubes'] else "",
+        slab = config['split_slab']
     shell:
-        "python workflow/scripts/split_subcube.py -d {params.incube} -c {params.coord_file} -i {wildcards.idx} | tee {log}"
+        "python workflow/scripts/global_noise.py -d {params.incube} -p {input[1]} -o {output[0]} {params.noise_cube} -t {threads} -s {params.slab} | tee {log}"
+
+if config['split_batch'] and not config['chunk_planner']:
+    rule split_subcubes:
+        input:
+            config['incube'],
+            config['coord_file'],
+            config['grid_plot'],
+            [config['channel_noise']] if config['global_noise'] else []
+        output:
+            [interim(subcube) for subcube in expand("interim/subcubes/subcube_{idx}.fits", idx=IDX)],
+            expand("interim/subcubes/subcube_{idx}.hdr", idx=IDX),
+            [interim(noise) for noise in expand("interim/subcubes/noise_{idx}.fits", idx=IDX)] if config['global_noise'] else []
+        log:
+            "results/logs/split_subcube/split_subcubes.log"
+        benchmark:
+            "results/benchmarks/split_subcube/split_subcubes.tsv"
+        conda:
+            "../envs/chunk_data.yml"
+        params:
+            incube = config['incube'],
+            coord_file = config['coord_file'],
+            indices = ','.join(str(idx) for idx in IDX),
+            slab = config['split_slab'],
+            noise = f"-n {config['channel_noise']}" if config['global_noise'] else ""
+        shell:
+            "python workflow/scripts/split_subcube.py -d {params.incube} -c {params.coord_file} -i {params.indices} -b -s {params.slab} {params.noise} | tee {log}"
+else:
+    rule split_subcube:
+        input:
+            config['incube'],
+            config['coord_file'],
+            config['grid_plot'],
+            [config['channel_noise']] if config['global_noise'] else [],
+            unpack(quota_input)
+        output:
+            interim("interim/subcubes/subcube_{idx}.fits"),
+            "interim/subcubes/subcube_{idx}.hdr",
+            [interim("interim/subcubes/noise_{idx}.fits")] if config['global_noise'] else []
+        log:
+            "results/logs/split_subcube/subcube_{idx}.log"
+        benchmark:
+            "results/benchmarks/split_subcube/subcube_{idx}.tsv"
+        resources:
+            bigfile=1
+        conda:
+            "../envs/chunk_data.yml"
+        params:
+            incube = config['incube'],
+            coord_file = config['coord_file'],
+            noise = f"-n {config['channel_noise']}" if config['global_noise'] else ""
+        shell:
+            "python workflow/scripts/split_subcube.py -d {params.incube} -c {params.coord_file} -i {wildcards.idx} {params.noise} | tee {log}"
@@ -1,32 +1,60 @@
 
+rule deduplicate_subcube:
+    input:
+        datacube = config['incube'],
+        coord_file = config['coord_file'],
+        catalog = "results/sofia/{idx}/subcube_{idx}_final_catalog." + CAT_FORMAT,
+        neighbours = neighbour_catalogs
+    output:
+        "results/sofia/{idx}/subcube_{idx}_dedup_catalog." + CAT_FORMAT
+    conda:
+        "../envs/xmatch_catalogs.yml"
+    log:
+        "results/logs/deduplicate_subcube/subcube_{idx}.log"
+    benchmark:
+        "results/benchmarks/deduplicate_subcube/subcube_{idx}.tsv"
+    params:
+        slabs = "--slabs" if config['num_freq_slabs'] > 1 else ""
+    shell:
+        "python workflow/scripts/deduplicate_subcube.py -i {input.catalog} -n {input.neighbours} -o {output} --index {wildcards.idx} -d {input.datacube} -c {input.coord_file} {params.slabs} | tee {log}"
+
 rule concatenate_catalogs:
     input:
-        expand("results/sofia/{idx}/subcube_{idx}_final_catalog.csv", idx=IDX, allow_missing=True)
-        #aggregate_input
+        lambda wildcards: expand("results/sofia/{idx}/subcube_{idx}_{name}.{ext}", idx=chunk_indices(), name="dedup_catalog" if config['incremental_dedup'] else "final_catalog", ext=CAT_FORMAT)
     output:
-        "results/catalogs/catalog_w_duplicates.csv"
+        catalog = "results/catalogs/catalog_w_duplicates." + CAT_FORMAT,
+        row_counts = "results/catalogs/catalog_row_counts.csv"
+    conda:
+        "../envs/xmatch_catalogs.yml"
     log:
         "results/logs/concatenate/concatenate_catalogs.log"
-    run:
-        shell("awk 'FNR>1' {input} > {output} | tee {log}")
-	shell("sed -i '1i id_subcube ra dec hi_size line_flux_integral central_freq pa i w20 rms subcube' {output}")
+    benchmark:
+        "results/benchmarks/concatenate/concatenate_catalogs.tsv"
+    shell:
+        "python workflow/scripts/concatenate_catalogs.py -i {input} -o {output.catalog} -n {output.row_counts} | tee {log}"
 
 
 rule eliminate_duplicates:
     input:
-        "results/catalogs/catalog_w_duplicates.csv"
+        unpack(slab_input),
+        catalog = "results/catalogs/catalog_w_duplicates." + CAT_FORMAT
     output:
-        "results/catalogs/unfiltered_catalog.csv"
+        "results/catalogs/unfiltered_catalog." + CAT_FORMAT
     conda:
         "../envs/xmatch_catalogs.yml"
     log:
         "results/logs/concatenate/eliminate_duplicates.log"
+    benchmark:
+        "results/benchmarks/concatenate/eliminate_duplicates.tsv"
+    params:
+        coord = lambda wildcards, input: f"--coord {input.coord_file}" if config['num_freq_slabs'] > 1 else "",
+        skip_match = "--skip_match" if config['incremental_dedup'] else ""
     shell:
-        "python workflow/scripts/eliminate_duplicates.py -i {input} -o {output} | tee {log}"
+        "python workflow/scripts/eliminate_duplicates.py -i {input.catalog} -o {output} {params.coord} {params.skip_match} | tee {log}"
 
 rule final_catalog:
     input:
-        "results/catalogs/unfiltered_catalog.csv"
+        "results/catalogs/unfiltered_catalog." + CAT_FORMAT
     output:
         "results/catalogs/final_catalog.csv",
 	"results/catalogs/unfiltered_catalog_logMD.csv",
@@ -35,6 +63,8 @@ rule final_catalog:
         "../envs/filter_catalog.yml"
     log:
         "results/logs/concatenate/filter_catalog.log"
+    benchmark:
+        "results/benchmarks/concatenate/filter_catalog.tsv"
     shell:
         "python workflow/scripts/filter_catalog.py -i {input} -o {output[0]} | tee {log}"
 
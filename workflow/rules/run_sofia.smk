@@ -1,41 +1,152 @@
 rule run_sofia:
     input:
-        "interim/subcubes/subcube_{idx}.fits",
-	config['sofia_param']
+        unpack(subcube_input),
+        unpack(resource_input),
+        unpack(noise_input),
+        parfile = config['sofia_param']
     output:
         "results/sofia/{idx}/subcube_{idx}_cat.txt",
 	"results/sofia/{idx}/sofia.par"
     log:
         "results/logs/run_sofia/subcube_{idx}.log"
+    benchmark:
+        "results/benchmarks/run_sofia/subcube_{idx}.tsv"
+    priority:
+        1
     threads:
-        config['threads']
+        chunk_resource('threads', config['threads'])
+    resources:
+        mem_mb = chunk_resource('mem_mb', config['mem_per_job_mb'])
     conda:
         "../envs/process_data.yml"
     params:
 #        sofia_param = config['sofia_param'],
         scfind_threshold = config['scfind_threshold'],
         reliability_fmin = config['reliability_fmin'],
-        reliability_threshold = config['reliability_threshold']
+        reliability_threshold = config['reliability_threshold'],
+        region = lambda wildcards, input: f"--coord {input.coord_file} --index {wildcards.idx}" if config['virtual_subcubes'] else "",
+        noise = lambda wildcards, input: f"--noise {input.noise}" if config['global_noise'] else "",
+        cache = f"--cache_dir {config['sofia_cache']} --cache_size {config['sofia_cache_size_gb']}" if config['sofia_cache'] else ""
     shell:
-        "python workflow/scripts/run_sofia.py --parfile {input[1]}\
-	--outname {wildcards.idx} --datacube {input[0]} -r results/sofia\
+        "python workflow/scripts/run_sofia.py --parfile {input.parfile}\
+	--outname {wildcards.idx} --datacube {input.datacube} -r results/sofia\
         --scfind_threshold {params.scfind_threshold}\
 	--reliability_fmin {params.reliability_fmin}\
 	--reliability_threshold {params.reliability_threshold}\
-        | tee {log}"
+        --threads {threads} {params.region} {params.noise} {params.cache} | tee {log}"
 
-rule sofia2cat:
+rule sofia_sweep:
     input:
-        "interim/subcubes/subcube_{idx}.fits",
-        "results/sofia/{idx}/subcube_{idx}_cat.txt",
-	"results/sofia/{idx}/sofia.par"
+        unpack(split_noise_input),
+        datacube = "interim/subcubes/subcube_{idx}.fits",
+        parfile = config['sofia_param']
     output:
-        "results/sofia/{idx}/subcube_{idx}_final_catalog.csv"
+        "results/sofia/{idx}/sweep/sweep_catalogs.csv"
     log:
-        "results/logs/sofia2cat/subcube_{idx}.log"
+        "results/logs/sofia_sweep/subcube_{idx}.log"
+    benchmark:
+        "results/benchmarks/sofia_sweep/subcube_{idx}.tsv"
+    threads:
+        config['threads']
     conda:
         "../envs/process_data.yml"
     params:
-        sofia_param = config['sofia_param']
+        scfind_threshold = ','.join(str(value) for value in config['sweep_scfind_threshold']),
+        reliability_fmin = ','.join(str(value) for value in config['sweep_reliability_fmin']),
+        reliability_threshold = ','.join(str(value) for value in config['sweep_reliability_threshold']),
+        noise = lambda wildcards, input: f"--noise {input.noise}" if config['global_noise'] else ""
     shell:
-        "python workflow/scripts/sofia2cat.py --outname {wildcards.idx} -r results/sofia --incatalog {input[1]} | tee {log}"
+        "python workflow/scripts/run_sofia.py --parfile {input.parfile}\
+        --outname {wildcards.idx} --datacube {input.datacube} -r results/sofia\
+        --scfind_threshold {params.scfind_threshold}\
+        --reliability_fmin {params.reliability_fmin}\
+        --reliability_threshold {params.reliability_threshold}\
+        --threads {threads} {params.noise} --sweep | tee {log}"
+
+rule sweep:
+    input:
+        lambda wildcards: expand("results/sofia/{idx}/sweep/sweep_catalogs.csv", idx=chunk_indices())
+
+def sofia2cat_input(wildcards):
+    '''Inputs of sofia2cat for subcube `idx`'''
+    return {**header_input(wildcards), **slab_input(wildcards)}
+
+if config['stage_chunks']:
+    rule process_chunk:
+        input:
+            unpack(resource_input),
+            unpack(staged_noise_input),
+            datacube = config['incube'],
+            coord_file = config['coord_file'],
+            parfile = config['sofia_param']
+        output:
+            "results/sofia/{idx}/subcube_{idx}_final_catalog." + CAT_FORMAT
+        log:
+            "results/logs/process_chunk/subcube_{idx}.log"
+        benchmark:
+            "results/benchmarks/process_chunk/subcube_{idx}.tsv"
+        threads:
+            chunk_resource('threads', config['threads'])
+        resources:
+            mem_mb = chunk_resource('mem_mb', config['mem_per_job_mb'])
+        conda:
+            "../envs/process_data.yml"
+        params:
+            scfind_threshold = config['scfind_threshold'],
+            reliability_fmin = config['reliability_fmin'],
+            reliability_threshold = config['reliability_threshold'],
+            catalog_format = CAT_FORMAT,
+            scratch = f"--scratch {config['scratch_dir']}" if config['scratch_dir'] else "",
+            options = ' '.join(option for option, enabled in [
+                ("--virtual", config['virtual_subcubes']),
+                ("--slabs", config['num_freq_slabs'] > 1),
+                ("--keep_cubelets", config['stage_keep_cubelets'])] if enabled),
+            noise = lambda wildcards, input: f"--noise {input.noise}" if config['global_noise'] else "",
+            cache = f"--cache_dir {config['sofia_cache']} --cache_size {config['sofia_cache_size_gb']}" if config['sofia_cache'] else ""
+        shell:
+            "python workflow/scripts/process_chunk.py -i {wildcards.idx} -d {input.datacube} -c {input.coord_file} -p {input.parfile} -r results/sofia {params.scratch} -s {params.scfind_threshold} -f {params.reliability_fmin} -t {params.reliability_threshold} --threads {threads} --format {params.catalog_format} {params.options} {params.noise} {params.cache} | tee {log}"
+elif config['sofia2cat_batch'] and not config['chunk_planner']:
+    rule sofia2cat_batch:
+        input:
+            unpack(slab_input),
+            catalogs = expand("results/sofia/{idx}/subcube_{idx}_cat.txt", idx=IDX),
+            parfiles = expand("results/sofia/{idx}/sofia.par", idx=IDX),
+            headers = [chunk_header(idx) for idx in IDX]
+        output:
+            expand("results/sofia/{idx}/subcube_{idx}_final_catalog." + CAT_FORMAT, idx=IDX)
+        log:
+            "results/logs/sofia2cat/sofia2cat_batch.log"
+        benchmark:
+            "results/benchmarks/sofia2cat/sofia2cat_batch.tsv"
+        threads:
+            config['threads']
+        conda:
+            "../envs/process_data.yml"
+        params:
+            indices = ' '.join(str(idx) for idx in IDX),
+            catalog_format = CAT_FORMAT,
+            coord = lambda wildcards, input: f"--coord {input.coord_file}" if config['num_freq_slabs'] > 1 else ""
+        shell:
+            "python workflow/scripts/sofia2cat.py --outname {params.indices} -r results/sofia --incatalog {input.catalogs} --format {params.catalog_format} --header {input.headers} -j {threads} {params.coord} | tee {log}"
+else:
+    rule sofia2cat:
+        input:
+            unpack(sofia2cat_input),
+            catalog = "results/sofia/{idx}/subcube_{idx}_cat.txt",
+            parfile = "results/sofia/{idx}/sofia.par"
+        output:
+            "results/sofia/{idx}/subcube_{idx}_final_catalog." + CAT_FORMAT
+        log:
+            "results/logs/sofia2cat/subcube_{idx}.log"
+        benchmark:
+            "results/benchmarks/sofia2cat/subcube_{idx}.tsv"
+        priority:
+            2
+        conda:
+            "../envs/process_data.yml"
+        params:
+            sofia_param = config['sofia_param'],
+            catalog_format = CAT_FORMAT,
+            coord = lambda wildcards, input: f"--coord {input.coord_file}" if config['num_freq_slabs'] > 1 else ""
+        shell:
+            "python workflow/scripts/sofia2cat.py --outname {wildcards.idx} -r results/sofia --incatalog {input.catalog} --format {params.catalog_format} --header {input.header} {params.coord} | tee {log}"
@@ -33,3 +33,19 @@ rule filegraph:
         "../envs/snakemake.yml"
     shell:
         "snakemake --forceall --filegraph | dot -Tsvg > {output}"
+
+rule performance_report:
+    input:
+        "results/catalogs/final_catalog.csv"
+    output:
+        "summary/performance.csv",
+        "summary/performance.png"
+    log:
+        "results/logs/summary/performance_report.log"
+    conda:
+        "../envs/analysis.yml"
+    params:
+        threads = config['threads'],
+        resources = f"-r {config['chunk_costs'] if config['load_balance'] else config['chunk_resources']}" if config['load_balance'] or config['scale_resources'] else ""
+    shell:
+        "python workflow/scripts/performance_report.py -b results/benchmarks -o {output[0]} -p {output[1]} -t {params.threads} {params.resources} | tee {log}"
@@ -2,7 +2,8 @@
 rule visualize:
     input:
         "results/catalogs/final_catalog.csv",
-        "results/catalogs/catalog_w_duplicates.csv",
+        "results/catalogs/catalog_w_duplicates." + CAT_FORMAT,
+        "results/catalogs/catalog_row_counts.csv",
         "results/catalogs/unfiltered_catalog_logMD.csv",
         "results/catalogs/unfiltered_catalog_logMD_filtered.csv",
 	"resources/sky_ldev_truthcat_v2.txt",
@@ -16,6 +17,8 @@ rule visualize:
         "results/logs/visualize/visualize.log",
         # optional path to the processed notebook
         notebook="results/notebooks/sdc2_hi-friends.ipynb"
+    benchmark:
+        "results/benchmarks/visualize/visualize.tsv"
     conda:
         "../envs/analysis.yml"
     notebook:
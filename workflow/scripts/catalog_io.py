@@ -0,0 +1,90 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This module reads and writes the intermediate catalogs of the workflow,
+either as space-delimited text or as typed columnar Parquet files
+'''
+
+import os
+import pandas as pd
+
+CATALOG_FORMATS = ['csv', 'parquet']
+# Columns of the catalogs of the subcubes and of their concatenation
+CATALOG_COLUMNS = ['id_subcube', 'ra', 'dec', 'hi_size', \
+                   'line_flux_integral', 'central_freq', 'pa', 'i', 'w20', \
+                   'rms', 'subcube']
+
+def catalog_format(filename):
+    '''Returns the format of a catalog from the extension of its name
+
+    Parameters
+    ----------
+    filename: str
+        Catalog file name
+    Returns
+    -------
+    fmt: str
+        `parquet` for files ending in .parquet, `csv` otherwise
+    '''
+    if os.path.splitext(filename)[1] == '.parquet':
+        return 'parquet'
+    return 'csv'
+
+def is_columnar(filename):
+    '''Returns True if the catalog is stored in a columnar format
+
+    Parameters
+    ----------
+    filename: str
+        Catalog file name
+    Returns
+    -------
+    columnar: bool
+        True for Parquet catalogs
+    '''
+    return catalog_format(filename) == 'parquet'
+
+def read_catalog(filename):
+    '''Reads a catalog in any of the supported formats
+
+    Parameters
+    ----------
+    filename: str
+        Catalog file name
+    Returns
+    -------
+    cat: pandas.DataFrame
+        Catalog
+    '''
+    if is_columnar(filename):
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename, delimiter=' ')
+
+def write_catalog(cat, filename):
+    '''Writes a catalog in the format given by the extension of its name
+
+    Parameters
+    ----------
+    cat: pandas.DataFrame
+        Catalog
+    filename: str
+        Catalog file name
+    '''
+    if is_columnar(filename):
+        cat.to_parquet(filename, index=False)
+    else:
+        cat.to_csv(filename, sep=' ', index=False)
@@ -0,0 +1,168 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script concatenates the catalogs of the subcubes in a single catalog,
+checking that all of them have the expected columns
+'''
+
+import argparse
+import pandas as pd
+from catalog_io import CATALOG_COLUMNS, is_columnar, write_catalog
+
+CHUNK_SIZE = 2**20
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Concatenate the catalogs of the subcubes'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--infiles', dest='infiles', nargs='*', \
+                        help='catalogs of the subcubes')
+    parser.add_argument('-o', '--outfile', dest='outfile',\
+                        help='concatenated catalog')
+    parser.add_argument('-n', '--row_counts', dest='row_counts', \
+                        default=None, help='Output file with the number of \
+                        sources in each catalog')
+    args = parser.parse_args()
+    return args
+
+def check_columns(infile, columns):
+    '''Checks that a catalog has the expected columns
+
+    Parameters
+    ----------
+    infile: str
+        catalog of a subcube
+    columns: list of str
+        Columns of the catalog
+    '''
+    if list(columns) != CATALOG_COLUMNS:
+        raise ValueError(f'Unexpected columns in {infile}: {list(columns)}. '
+                         f'Expected {CATALOG_COLUMNS}')
+
+def copy_text_catalog(infile, fileout):
+    '''Copies the rows of a text catalog, without its header, to an open
+    file. A missing line break at the end of the file is added
+
+    Parameters
+    ----------
+    infile: str
+        catalog of a subcube
+    fileout: file object
+        Concatenated catalog, opened in binary mode
+    Returns
+    -------
+    n_rows: int
+        Number of rows copied
+    '''
+    n_rows = 0
+    with open(infile, 'rb') as filein:
+        check_columns(infile, filein.readline().decode().split())
+        last = b'\n'
+        for chunk in iter(lambda: filein.read(CHUNK_SIZE), b''):
+            fileout.write(chunk)
+            n_rows += chunk.count(b'\n')
+            last = chunk[-1:]
+        if last != b'\n':
+            fileout.write(b'\n')
+            n_rows += 1
+    return n_rows
+
+def concatenate_text_catalogs(infiles, outfile):
+    '''Concatenates text catalogs in a single pass, writing the header once
+
+    Parameters
+    ----------
+    infiles: list of str
+        catalogs of the subcubes
+    outfile: str
+        concatenated catalog
+    Returns
+    -------
+    row_counts: list of int
+        Number of rows of each catalog
+    '''
+    with open(outfile, 'wb') as fileout:
+        fileout.write((' '.join(CATALOG_COLUMNS) + '\n').encode())
+        return [copy_text_catalog(infile, fileout) for infile in infiles]
+
+def concatenate_columnar_catalogs(infiles, outfile):
+    '''Concatenates Parquet catalogs, appending each of them to the output
+    file as a row group. Empty catalogs are skipped, and an empty catalog is
+    written if there are no sources at all
+
+    Parameters
+    ----------
+    infiles: list of str
+        catalogs of the subcubes
+    outfile: str
+        concatenated catalog
+    Returns
+    -------
+    row_counts: list of int
+        Number of rows of each catalog
+    '''
+    # pyarrow is only needed for Parquet catalogs
+    import pyarrow.parquet as pq
+    row_counts = []
+    writer = None
+    for infile in infiles:
+        table = pq.read_table(infile)
+        check_columns(infile, table.column_names)
+        row_counts.append(table.num_rows)
+        if table.num_rows == 0:
+            continue
+        if writer is None:
+            writer = pq.ParquetWriter(outfile, table.schema)
+        writer.write_table(table.cast(writer.schema))
+    if writer is None:
+        write_catalog(pd.DataFrame(columns=CATALOG_COLUMNS), outfile)
+    else:
+        writer.close()
+    return row_counts
+
+def concatenate_catalogs(infiles, outfile, row_counts_file=None):
+    '''Concatenates catalogs in the format given by the extension of
+    `outfile`, and optionally writes the number of rows of each of them
+
+    Parameters
+    ----------
+    infiles: list of str
+        catalogs of the subcubes
+    outfile: str
+        concatenated catalog
+    row_counts_file: str
+        Output file with the number of sources in each catalog
+    '''
+    if is_columnar(outfile):
+        row_counts = concatenate_columnar_catalogs(infiles, outfile)
+    else:
+        row_counts = concatenate_text_catalogs(infiles, outfile)
+    for infile, n_rows in zip(infiles, row_counts):
+        print(infile, n_rows)
+    print(f'Number of sources: {sum(row_counts)}')
+    if row_counts_file is not None:
+        pd.DataFrame({'catalog': infiles, 'rows': row_counts}).to_csv(
+            row_counts_file, index=False)
+
+def main():
+    '''Concatenates the catalogs of the subcubes'''
+    args = get_args()
+    concatenate_catalogs(args.infiles, args.outfile,
+                         row_counts_file=args.row_counts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script removes the duplicates of the catalog of one subcube, matching
+its sources only against the sources of the neighbouring subcubes found in
+the overlapping regions
+'''
+
+import argparse
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import vstack
+from astropy.wcs import WCS
+from split_subcube import read_coord_file
+from catalog_io import CATALOG_COLUMNS, is_columnar, read_catalog, \
+        write_catalog
+from eliminate_duplicates import read_ref_catalog, \
+        read_coordinates_from_table, find_catalog_duplicates, \
+        restrict_to_spectral_overlap, mask_worse_duplicates
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Eliminate duplicates from the catalog of one subcube'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--infile', dest='infile', \
+                        help='catalog of the subcube')
+    parser.add_argument('-n', '--neighbours', dest='neighbours', nargs='*', \
+                        default=[], help='catalogs of the neighbouring \
+                        subcubes')
+    parser.add_argument('-o', '--outfile', dest='outfile',\
+                        help='catalog of the subcube without duplicated \
+                        sources')
+    parser.add_argument('--index', dest='idx', type=int, \
+                        help='Subcube index')
+    parser.add_argument('-d', '--datacube', dest='datacube', \
+                        help='Data cube, whose header gives the pixel \
+                        positions of the sources')
+    parser.add_argument('-c', '--coord', dest='coord_file', \
+                        help='File with edge coordinates of subcubes')
+    parser.add_argument('--slabs', dest='slabs', action='store_true', \
+                        help='Duplicates must lie in the frequency range of \
+                        both subcubes', default=False)
+    args = parser.parse_args()
+    return args
+
+def overlap_strip(neighbour_table, wcs, bounds, margin):
+    '''Returns the sources of the neighbouring subcubes inside the pixel
+    bounds of the subcube, extended by `margin` pixels. Only these sources
+    lie in the regions overlapping the subcube
+
+    Parameters
+    ----------
+    neighbour_table: astropy.Table
+        table with the detections of the neighbouring subcubes
+    wcs: class astropy.wcs
+        celestial wcs of the data cube
+    bounds: structured array
+        row of the grid of subcubes with the pixel bounds of the subcube
+    margin: float
+        Margin around the subcube in pixels
+    Returns
+    -------
+    strip: Bool array
+        array with True for the sources of `neighbour_table` in the strip
+    '''
+    pix_x, pix_y = wcs.all_world2pix(
+        np.asarray(neighbour_table['ra'], dtype=float),
+        np.asarray(neighbour_table['dec'], dtype=float), 0)
+    return (pix_x >= bounds['x0'] - margin) & \
+           (pix_x <= bounds['x1'] - 1 + margin) & \
+           (pix_y >= bounds['y0'] - margin) & \
+           (pix_y <= bounds['y1'] - 1 + margin)
+
+def select_overlap_sources(catalog_table, neighbour_table, max_sep=3):
+    '''Selects the sources of the neighbouring subcubes that belong to the
+    same groups of duplicates as the sources of the subcube. Sources closer
+    than `max_sep` to the selection are added until the groups are
+    complete. Only sources in the overlapping regions are close enough
+
+    Parameters
+    ----------
+    catalog_table: astropy.Table
+        table with the detections of the subcube
+    neighbour_table: astropy.Table
+        table with the detections of the neighbouring subcubes
+    max_sep: float
+        Maximum separation of duplicates in arcsec
+    Returns
+    -------
+    overlap_table: astropy.Table
+        rows of `neighbour_table` connected to a source of the subcube
+    '''
+    selected = np.zeros(len(neighbour_table), dtype=bool)
+    if len(catalog_table) == 0 or len(neighbour_table) == 0:
+        return neighbour_table[selected]
+    frontier = SkyCoord(ra=catalog_table['ra']*u.degree,
+                        dec=catalog_table['dec']*u.degree)
+    neighbour_coord = SkyCoord(ra=neighbour_table['ra']*u.degree,
+                               dec=neighbour_table['dec']*u.degree)
+    while len(frontier) > 0:
+        _, d2d, _ = neighbour_coord.match_to_catalog_sky(frontier)
+        new = (d2d < max_sep*u.arcsec) & ~selected
+        selected |= new
+        frontier = neighbour_coord[new]
+    return neighbour_table[selected]
+
+def deduplicate_subcube(infile, neighbours, datacube, coord_file, idx,
+                        slabs=False, max_sep=3):
+    '''Finds the sources of the subcube that are worse duplicates of other
+    sources. The result is the same as for these sources in the full
+    catalog, because their groups of duplicates are complete. The sources of
+    the neighbouring subcubes are first restricted to the strip overlapping
+    the subcube, with a margin of two separations. If a group reaches the
+    edge of the strip, it is completed from the full neighbouring catalogs
+
+    Parameters
+    ----------
+    infile: str
+        catalog of the subcube
+    neighbours: list of str
+        catalogs of the neighbouring subcubes
+    datacube: str
+        Data cube, whose header gives the pixel positions of the sources
+    coord_file: str
+        File with edge coordinates of subcubes
+    idx: int
+        Index of subcube
+    slabs: bool
+        If True, duplicates must lie in the frequency range of both subcubes
+    max_sep: float
+        Maximum separation of duplicates in arcsec
+    Returns
+    -------
+    keep: Bool array
+        array with True for the sources of the subcube that are kept
+    '''
+    catalog_table = read_ref_catalog(infile, name_list=CATALOG_COLUMNS)
+    n_sources = len(catalog_table)
+    coord_subcubes = read_coord_file(coord_file)
+    if neighbours:
+        neighbour_table = vstack([read_ref_catalog(neighbour, CATALOG_COLUMNS)
+                                  for neighbour in neighbours])
+        wcs = WCS(fits.getheader(datacube)).celestial
+        sep_pix = max_sep/3600/np.abs(wcs.wcs.get_cdelt()[1])
+        strip = overlap_strip(neighbour_table, wcs, coord_subcubes[idx],
+                              2*sep_pix)
+        print(f'Sources from neighbouring subcubes in the overlapping '
+              f'strip: {np.count_nonzero(strip)} of {len(neighbour_table)}')
+        overlap_table = select_overlap_sources(catalog_table,
+                                               neighbour_table[strip],
+                                               max_sep=max_sep)
+        if not all(overlap_strip(overlap_table, wcs, coord_subcubes[idx],
+                                 sep_pix)):
+            print('A group of duplicates reaches the edge of the strip, '
+                  'matching all the sources of the neighbouring subcubes')
+            overlap_table = select_overlap_sources(catalog_table,
+                                                   neighbour_table,
+                                                   max_sep=max_sep)
+        print(f'Sources from neighbouring subcubes in the overlapping '
+              f'regions: {len(overlap_table)}')
+        catalog_table = vstack([catalog_table, overlap_table])
+    if len(catalog_table) < 2:
+        return np.ones(n_sources, dtype=bool)
+    ras, dec, freq = read_coordinates_from_table(catalog_table)
+    pairs = find_catalog_duplicates(ras, dec, freq, max_sep=max_sep*u.arcsec)
+    if slabs:
+        pairs = restrict_to_spectral_overlap(pairs, catalog_table,
+                                             coord_subcubes)
+    duplicates = mask_worse_duplicates(pairs, catalog_table)
+    return ~duplicates[:n_sources]
+
+def write_subcube_catalog(infile, outfile, keep):
+    '''Writes the catalog of the subcube for the kept sources. Text catalogs
+    are written line by line, so the values are not reformatted
+
+    Parameters
+    ----------
+    infile: str
+        catalog of the subcube
+    outfile: str
+        catalog of the subcube without duplicated sources
+    keep: Bool array
+        array with True for the sources of the subcube that are kept
+    '''
+    if is_columnar(infile):
+        write_catalog(read_catalog(infile)[keep], outfile)
+    else:
+        with open(infile, 'r') as filein:
+            lines = [line for line in filein if line.strip()]
+        with open(outfile, 'w') as fileout:
+            fileout.write(lines[0])
+            fileout.writelines(line for line, k in zip(lines[1:], keep) if k)
+    print(f'Sources kept: {np.count_nonzero(keep)} of {len(keep)}')
+
+def main():
+    '''Removes duplicates from the catalog of one subcube'''
+    args = get_args()
+    keep = deduplicate_subcube(args.infile, args.neighbours, args.datacube,
+                               args.coord_file, args.idx, slabs=args.slabs)
+    write_subcube_catalog(args.infile, args.outfile, keep)
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,16 @@ This script defines the coordintes of grid of subcubes
 '''
 
 import argparse
-from spectral_cube import SpectralCube
 import numpy as np
+from astropy import units as u
+from astropy import constants as const
+from astropy.io import fits
+from astropy.wcs import WCS
 import matplotlib.pyplot as plt
 
+# Rest frequency of the HI line, used if the header does not give one
+F0_HI = 1420405751.786    # Hz
+
 def get_args():
     '''This function parses and returns arguments passed in'''
     description = 'Define coordinates of grid of subcubes'
@@ -38,42 +44,339 @@ def get_args():
                         direction.')
     parser.add_argument('-c', '--coord', dest='coord_file',
             help='File with edge coordinates of subcubes')
+    parser.add_argument('-z', '--num_slabs', dest='num_slabs', default=1, \
+                        help='Number of slabs to divide the frequency axis')
+    parser.add_argument('-v', '--channel_overlap', dest='channel_overlap', \
+                        default=0, help='Number of channels to extend each \
+                        slab in each direction.')
+    parser.add_argument('-r', '--resources', dest='resources_file', \
+                        default=None, help='Output file with the memory \
+                        required by each subcube')
+    parser.add_argument('-b', '--bytes_per_voxel', dest='bytes_per_voxel', \
+                        default=16, help='Memory used by Sofia per voxel of \
+                        a subcube, in bytes')
+    parser.add_argument('--plan', dest='plan', action='store_true', \
+                        default=False, help='Choose the grid and the \
+                        overlaps from the memory budget instead of using \
+                        num_subcubes, overlap, num_slabs and channel_overlap')
+    parser.add_argument('-p', '--parfile', dest='parfile', default=None, \
+                        help='Sofia parameters file used to derive the \
+                        overlaps in planner mode, and to check the channel \
+                        overlap between slabs otherwise')
+    parser.add_argument('-m', '--mem_per_job', dest='mem_per_job', \
+                        default=16000, help='Memory available per job in MB, \
+                        in planner mode')
+    parser.add_argument('--cores', dest='cores', default=1, help='Number of \
+                        cores available, in planner mode')
+    parser.add_argument('--threads', dest='threads', default=1, help='Number \
+                        of threads given to the largest subcube')
     args = parser.parse_args()
     return args
 
-def define_subcubes(steps, wcs, overlap, subcube_size_pix):
-    '''Return an array with the coordinates of the subcubes
+def grid_ranges(steps, subcube_size_pix):
+    '''Return the pixel ranges of a regular grid along one axis
 
     Parameters
     ----------
     steps: int
         Steps to grid the cube.
+    subcube_size_pix: int
+        Number of pixels of the side of the subcubes
+    Returns
+    -------
+    ranges: list of tuples
+        First and last (excluded) pixel of each subcube, without overlap
+    '''
+    return [(s, s+subcube_size_pix) for s in steps]
+
+def split_axis(n_pix, num):
+    '''Return the pixel ranges dividing an axis in `num` parts of (almost)
+    equal size
+
+    Parameters
+    ----------
+    n_pix: int
+        Number of pixels of the axis
+    num: int
+        Number of parts
+    Returns
+    -------
+    ranges: list of tuples
+        First and last (excluded) pixel of each part, without overlap
+    '''
+    edges = np.linspace(0, n_pix, num+1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+def define_subcubes(x_ranges, y_ranges, wcs, overlap):
+    '''Return an array with the coordinates of the subcubes
+
+    Parameters
+    ----------
+    x_ranges: list of tuples
+        Pixel ranges of the subcubes along the x axis, without overlap
+    y_ranges: list of tuples
+        Pixel ranges of the subcubes along the y axis, without overlap
     wcs: class astropy.wcs
         wcs of the fits file
     overlap: int
         Number of pixels overlaping between subcubes
-    subcube_size_pix: int
-        Number of pixels of the side of the subcubes
     Returns
     -------
     coord_subcubes: array
         Array with the coordinates of rthe subcubes
     '''
-    coord_subcubes = []
-    for s_x in steps:
-        for s_y in steps:
-            c_0 = wcs.pixel_to_world(s_x-overlap/2, s_y-overlap/2, 0)[0]
-            c_1 = wcs.pixel_to_world(s_x+subcube_size_pix+overlap/2, \
-                                    s_y+subcube_size_pix+overlap/2, 0)[0]
-            xlo = c_0.ra.deg
-            xhi = c_1.ra.deg
-            ylo = c_0.dec.deg
-            yhi = c_1.dec.deg
-            coord_subcubes.append([xlo,ylo, xhi, yhi])
-            #print(s_x-overlap/2, s_y-overlap/2, s_x+subcube_size_pix+overlap/2,\
-            #      s_y+subcube_size_pix+overlap/2)
-            #print(xlo, xhi, ylo, yhi)
-    return np.array(coord_subcubes)
+    # Corners of all the subcubes, in the same order as the nested loops
+    # over x_ranges and y_ranges, converted in a single call
+    x_lo, x_hi = np.repeat(np.array(x_ranges, dtype=float), len(y_ranges),
+                           axis=0).T
+    y_lo, y_hi = np.tile(np.array(y_ranges, dtype=float),
+                         (len(x_ranges), 1)).T
+    corners = wcs.celestial.pixel_to_world(
+        np.concatenate([x_lo - overlap/2, x_hi + overlap/2]),
+        np.concatenate([y_lo - overlap/2, y_hi + overlap/2]))
+    c_0 = corners[:len(x_lo)]
+    c_1 = corners[len(x_lo):]
+    return np.column_stack([c_0.ra.deg, c_0.dec.deg, c_1.ra.deg, c_1.dec.deg])
+
+def define_slabs(n_chan, num_slabs, channel_overlap):
+    '''Return the channel ranges of the slabs dividing the frequency axis
+
+    Parameters
+    ----------
+    n_chan: int
+        Number of channels of the cube
+    num_slabs: int
+        Number of slabs
+    channel_overlap: int
+        Number of channels overlaping between slabs
+    Returns
+    -------
+    slabs: list of tuples
+        First and last (excluded) channel of each slab
+    '''
+    slabs = []
+    for z_0, z_1 in split_axis(n_chan, num_slabs):
+        slabs.append((max(z_0 - channel_overlap//2, 0),
+                      min(z_1 + (channel_overlap+1)//2, n_chan)))
+    return slabs
+
+def spectral_to_frequency(values, wcs):
+    '''Convert values of the spectral axis to frequency. Velocity axes are
+    converted with the convention given by their type: radio (VRAD),
+    optical (VOPT, FELO) or relativistic (VELO)
+
+    Parameters
+    ----------
+    values: array
+        Spectral coordinates in the units of the spectral axis
+    wcs: class astropy.wcs
+        wcs of the fits file
+    Returns
+    -------
+    freq: array
+        Frequencies in Hz
+    '''
+    axis = wcs.wcs.spec
+    ctype = wcs.wcs.ctype[axis].split('-')[0]
+    if ctype == 'FREQ':
+        return (np.asarray(values)*u.Unit(wcs.wcs.cunit[axis] or 'Hz')
+                ).to_value(u.Hz)
+    beta = (np.asarray(values)*u.Unit(wcs.wcs.cunit[axis] or 'm/s')
+            ).to_value(u.m/u.s)/const.c.value
+    rest_freq = wcs.wcs.restfrq or F0_HI
+    if ctype == 'VRAD':
+        return rest_freq*(1 - beta)
+    if ctype in ('VOPT', 'FELO'):
+        return rest_freq/(1 + beta)
+    if ctype == 'VELO':
+        return rest_freq*np.sqrt((1 - beta)/(1 + beta))
+    raise ValueError(f'Unsupported spectral axis {wcs.wcs.ctype[axis]}')
+
+def define_spectral_bounds(wcs, slabs):
+    '''Return an array with the frequencies of the slabs, converted from the
+    units of the spectral axis, so that they can be compared with the
+    frequencies of the catalogs
+
+    Parameters
+    ----------
+    wcs: class astropy.wcs
+        wcs of the fits file
+    slabs: list of tuples
+        First and last (excluded) channel of each slab
+    Returns
+    -------
+    spectral_bounds: array
+        Array with the frequencies (zlo, zhi) in Hz of the first and last
+        channel of each slab
+    '''
+    z_0, z_1 = np.array(slabs).T
+    zlo = wcs.spectral.pixel_to_world_values(z_0)
+    zhi = wcs.spectral.pixel_to_world_values(z_1 - 1)
+    return np.column_stack([spectral_to_frequency(zlo, wcs),
+                            spectral_to_frequency(zhi, wcs)])
+
+def define_pixel_bounds(x_ranges, y_ranges, shape, overlap, slabs=None):
+    '''Return an array with the pixel bounds of the subcubes, in the same
+    order as `define_subcubes`
+
+    Parameters
+    ----------
+    x_ranges: list of tuples
+        Pixel ranges of the subcubes along the x axis, without overlap
+    y_ranges: list of tuples
+        Pixel ranges of the subcubes along the y axis, without overlap
+    shape: tuple
+        Shape of the data cube (nz, ny, nx)
+    overlap: int
+        Number of pixels overlaping between subcubes
+    slabs: list of tuples
+        First and last (excluded) channel of each slab. Default is a single
+        slab covering the full frequency axis
+    Returns
+    -------
+    pixel_bounds: array
+        Array with the pixel bounds (x0, x1, y0, y1, z0, z1) of the subcubes.
+        Upper bounds are excluded.
+    '''
+    n_z, n_y, n_x = shape
+    if slabs is None:
+        slabs = [(0, n_z)]
+    pixel_bounds = []
+    for x_lo, x_hi in x_ranges:
+        for y_lo, y_hi in y_ranges:
+            x_0 = max(x_lo - overlap//2, 0)
+            x_1 = min(x_hi + (overlap+1)//2, n_x)
+            y_0 = max(y_lo - overlap//2, 0)
+            y_1 = min(y_hi + (overlap+1)//2, n_y)
+            for z_0, z_1 in slabs:
+                pixel_bounds.append([x_0, x_1, y_0, y_1, z_0, z_1])
+    return np.array(pixel_bounds, dtype=int)
+
+def read_sofia_overlaps(parfile):
+    '''Return the overlaps between subcubes needed by the smoothing kernels
+    and the linker of Sofia: the largest kernel plus the linking radius on
+    each side
+
+    Parameters
+    ----------
+    parfile: str
+        Sofia parameters file
+    Returns
+    -------
+    pixel_overlap: int
+        Number of pixels overlaping between subcubes
+    channel_overlap: int
+        Number of channels overlaping between slabs
+    '''
+    params = {}
+    with open(parfile, 'r') as infile:
+        for line in infile.readlines():
+            if '=' in line and not line.strip().startswith('#'):
+                key, value = line.split('=', 1)
+                params[key.strip()] = value.split('#')[0].strip()
+    kernels_xy = [int(k) for k in params['scfind.kernelsXY'].split(',')]
+    kernels_z = [int(k) for k in params['scfind.kernelsZ'].split(',')]
+    pixel_overlap = max(kernels_xy) + 2*int(params['linker.radiusXY'])
+    channel_overlap = max(kernels_z) + 2*int(params['linker.radiusZ'])
+    return pixel_overlap, channel_overlap
+
+def check_channel_overlap(channel_overlap, parfile):
+    '''Check that the overlap between slabs covers the channels needed by the
+    smoothing kernels and the linker of Sofia. Sources touching the inner edge
+    of a slab are removed from its catalog, so with a smaller overlap a
+    source crossing the edge between two slabs is removed from both
+
+    Parameters
+    ----------
+    channel_overlap: int
+        Number of channels overlaping between slabs
+    parfile: str
+        Sofia parameters file
+    '''
+    min_overlap = read_sofia_overlaps(parfile)[1]
+    if channel_overlap < min_overlap:
+        raise ValueError(f'channel_overlap = {channel_overlap} is smaller '
+                         f'than the {min_overlap} channels of the largest '
+                         f'kernel and the linker of Sofia in {parfile}, so '
+                         'sources crossing the edges between slabs are lost')
+
+def plan_chunks(shape, mem_per_job, bytes_per_voxel, min_chunks,
+                pixel_overlap, channel_overlap, max_split=64):
+    '''Find the number of divisions of each axis that minimizes the total
+    number of voxels processed, including the overlaps, with every subcube
+    fitting in the memory available per job
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the data cube (nz, ny, nx)
+    mem_per_job: float
+        Memory available per job in MB
+    bytes_per_voxel: float
+        Memory used by Sofia per voxel of a subcube, in bytes
+    min_chunks: int
+        Minimum number of subcubes, to keep all the cores busy
+    pixel_overlap: int
+        Number of pixels overlaping between subcubes
+    channel_overlap: int
+        Number of channels overlaping between slabs
+    max_split: int
+        Maximum number of divisions of each axis
+    Returns
+    -------
+    n_split: tuple of int
+        Number of divisions of the x, y and frequency axes
+    '''
+    def chunk_size(n_pix, num, overlap):
+        return np.where(num > 1,
+                        np.minimum(np.ceil(n_pix/num) + overlap, n_pix), n_pix)
+    n_z, n_y, n_x = shape
+    num_x, num_y, num_z = np.meshgrid(np.arange(1, min(max_split, n_x)+1),
+                                      np.arange(1, min(max_split, n_y)+1),
+                                      np.arange(1, min(max_split, n_z)+1),
+                                      indexing='ij')
+    voxels = chunk_size(n_x, num_x, pixel_overlap) * \
+             chunk_size(n_y, num_y, pixel_overlap) * \
+             chunk_size(n_z, num_z, channel_overlap)
+    num_chunks = num_x * num_y * num_z
+    fits_memory = voxels*bytes_per_voxel/2**20 <= mem_per_job
+    valid = fits_memory & (num_chunks >= min_chunks)
+    if not valid.any():
+        raise ValueError(f'No grid of at most {max_split} divisions per axis '
+                         f'fits subcubes in {mem_per_job} MB')
+    # Minimize total work, then the number of subcubes
+    work = np.where(valid, voxels*num_chunks, np.inf)
+    best = np.lexsort((num_chunks[valid], work[valid]))[0]
+    return tuple(int(num[valid][best]) for num in (num_x, num_y, num_z))
+
+def write_chunk_resources(pixel_bounds, bytes_per_voxel, resources_file,
+                          threads=1):
+    '''Save file `resources_file` with the number of voxels, the memory
+    in MB required by Sofia and the threads for each subcube. The threads are
+    proportional to the number of voxels, so that the largest subcube gets
+    `threads`
+
+    Parameters
+    ----------
+    pixel_bounds: array
+        Array with the pixel bounds (x0, x1, y0, y1, z0, z1) of the subcubes
+    bytes_per_voxel: float
+        Memory used by Sofia per voxel of a subcube, in bytes
+    resources_file: str
+        Path to the output file
+    threads: int
+        Threads given to the largest subcube
+    '''
+    x_0, x_1, y_0, y_1, z_0, z_1 = pixel_bounds.T
+    voxels = (x_1-x_0)*(y_1-y_0)*(z_1-z_0)
+    mem_mb = np.ceil(voxels*bytes_per_voxel/2**20).astype(int)
+    n_threads = np.clip(np.ceil(threads*voxels/voxels.max()), 1,
+                        threads).astype(int)
+    np.savetxt(resources_file,
+               np.column_stack([np.arange(len(voxels)), voxels, mem_mb,
+                                n_threads]),
+               delimiter=",", header="idx,voxels,mem_mb,threads", fmt="%d",
+               comments='')
 
 def plot_subcubes(coord_subcubes, l_s='-', color=None, l_w=1):
     '''Plot subcubes
@@ -109,41 +412,56 @@ def plot_border(wcs, n_pix):
     n_pix: int
         Number of pixels of the cube side.
     '''
-    brc = wcs.pixel_to_world(0,0,0)[0]
-    trc = wcs.pixel_to_world(0,n_pix,0)[0]
-    tlc = wcs.pixel_to_world(n_pix,n_pix,0)[0]
-    blc = wcs.pixel_to_world(n_pix,0,0)[0]
-    plt.plot([brc.ra.deg, trc.ra.deg, tlc.ra.deg, blc.ra.deg, brc.ra.deg],
-             [brc.dec.deg, trc.dec.deg, tlc.dec.deg, blc.dec.deg, brc.dec.deg],
-            'k-', lw=4)
+    # Corners brc, trc, tlc, blc and back to brc
+    corners = wcs.celestial.pixel_to_world([0, 0, n_pix, n_pix, 0],
+                                           [0, n_pix, n_pix, 0, 0])
+    plt.plot(corners.ra.deg, corners.dec.deg, 'k-', lw=4)
 
 
-def write_subcubes(steps, wcs, overlap, subcube_size_pix, coord_file):
+def write_subcubes(x_ranges, y_ranges, wcs, overlap, coord_file,
+                   slabs=None):
     '''Return coordinates of subcubes. Save file `coord_file` in the results
-    folder containing the coordinates of the subcubes
+    folder containing the coordinates and the pixel bounds of the subcubes.
+    Each spatial subcube is divided in the frequency slabs `slabs`, and the
+    slabs of a spatial subcube have consecutive indices
 
     Parameters
     ----------
-    steps: int
-        Steps to grid the cube.
+    x_ranges: list of tuples
+        Pixel ranges of the subcubes along the x axis, without overlap
+    y_ranges: list of tuples
+        Pixel ranges of the subcubes along the y axis, without overlap
     wcs: class astropy.wcs
         wcs of the fits file
     overlap: int
         Number of pixels overlaping between subcubes
-    subcube_size_pix: int
-        Number of pixels of the side of the subcubes
+    coord_file: str
+        Path to the output file
+    slabs: list of tuples
+        First and last (excluded) channel of each slab. Default is a single
+        slab covering the full frequency axis
     Returns
     -------
     coord_subcubes array
         Array containing coordinates of subcubes of the edges of the subcubes
+    pixel_bounds: array
+        Array with the pixel bounds (x0, x1, y0, y1, z0, z1) of the subcubes
     '''
     # Find subcubes coordinates and write them
-    coord_subcubes = define_subcubes(steps, wcs, overlap, subcube_size_pix)
+    if slabs is None:
+        slabs = [(0, wcs.array_shape[0])]
+    coord_subcubes = define_subcubes(x_ranges, y_ranges, wcs, overlap)
+    spectral_bounds = define_spectral_bounds(wcs, slabs)
+    pixel_bounds = define_pixel_bounds(x_ranges, y_ranges, wcs.array_shape,
+                                       overlap, slabs=slabs)
+    world_bounds = np.hstack([np.repeat(coord_subcubes, len(slabs), axis=0),
+                              np.tile(spectral_bounds, (len(coord_subcubes), 1))])
     print(coord_file)
-    np.savetxt(coord_file, coord_subcubes, delimiter=",",
-               header="xlo,ylo,xhi,yhi",
-               fmt="%f", comments='')
-    return coord_subcubes
+    np.savetxt(coord_file, np.hstack([world_bounds, pixel_bounds]),
+               delimiter=",",
+               header="xlo,ylo,xhi,yhi,zlo,zhi,x0,x1,y0,y1,z0,z1",
+               fmt=["%f"]*6 + ["%d"]*6, comments='')
+    return coord_subcubes, pixel_bounds
 
 def plot_grid(wcs, coord_subcubes, grid_plot, n_pix):
     ''' Plot grid of subcubes
@@ -170,32 +488,111 @@ def plot_grid(wcs, coord_subcubes, grid_plot, n_pix):
     plt.gca().invert_xaxis()
     plt.savefig(grid_plot, bbox_inches='tight', dpi=200)
 
+def regular_ranges(n_pix, num_subcubes):
+    '''Pixel ranges of the subcubes along each spatial axis for a regular
+    grid of `num_subcubes` square subcubes
+
+    Parameters
+    ----------
+    n_pix: int
+        Number of pixels of the cube side
+    num_subcubes: int
+        Number of subcubes, a square number
+
+    Returns
+    -------
+    ranges: list
+        List of (start, end) pixel ranges along each axis
+    '''
+    subcube_size_pix = int(n_pix/np.sqrt(num_subcubes))
+    steps = np.arange(0, n_pix+1, subcube_size_pix)[:-1]
+    print(f"n_pix = {n_pix}")
+    print(f"subcube_size_pix = {subcube_size_pix}")
+    print(f"Number of subcubes = {num_subcubes}")
+    print(f"steps = {steps}")
+    return grid_ranges(steps, subcube_size_pix)
+
+def define_grid(wcs, x_ranges, y_ranges, pixel_overlap, num_slabs,
+                channel_overlap, coord_file, resources_file=None,
+                bytes_per_voxel=4, threads=1):
+    '''Define the grid of subcubes from the spatial ranges and the number of
+    frequency slabs, and save the grid file and, optionally, the file with
+    the resources of the subcubes
+
+    Parameters
+    ----------
+    wcs: class astropy.wcs
+        wcs of the fits file
+    x_ranges, y_ranges: list
+        List of (start, end) pixel ranges of the subcubes along each axis
+    pixel_overlap: int
+        Number of pixels of overlap between subcubes
+    num_slabs: int
+        Number of slabs along the frequency axis
+    channel_overlap: int
+        Number of channels of overlap between slabs
+    coord_file: str
+        Path to the output grid file
+    resources_file: str
+        Path to the output file with the resources of the subcubes, or None
+    bytes_per_voxel: float
+        Memory used by Sofia per voxel of a subcube, in bytes
+    threads: int
+        Threads given to the largest subcube
+
+    Returns
+    -------
+    coord_subcubes: array
+        Array containing coordinates of subcubes
+    '''
+    print(f"overlap = {pixel_overlap}")
+    slabs = define_slabs(wcs.array_shape[0], num_slabs, channel_overlap)
+    print(f"channel_overlap = {channel_overlap}")
+    print(f"slabs = {slabs}")
+
+    coord_subcubes, pixel_bounds = write_subcubes(x_ranges, y_ranges, wcs,
+            pixel_overlap, coord_file=coord_file, slabs=slabs)
+    if resources_file is not None:
+        write_chunk_resources(pixel_bounds, bytes_per_voxel,
+                              resources_file, threads=threads)
+    return coord_subcubes
+
 def main():
     '''Chunk the data cube in several subcubes'''
     args = get_args()
     infile = args.datacube
     grid_plot = args.grid_plot
     coord_file = args.coord_file
-    num_subcubes = int(args.num_subcubes)
-    pixel_overlap = int(args.pixel_overlap)
+    bytes_per_voxel = float(args.bytes_per_voxel)
 
-    # Read the cube and coordinates definition
-    cube = SpectralCube.read(infile)
-    wcs = cube.wcs
+    # Read the coordinates definition from the header only
+    wcs = WCS(fits.getheader(infile))
     n_pix = wcs.array_shape[1]
 
     # Define subcube properties
-    subcube_size_pix = int(n_pix/np.sqrt(num_subcubes))
-    steps = np.arange(0, n_pix+1, subcube_size_pix)[:-1]
-    overlap = pixel_overlap
-    print(f"n_pix = {n_pix}")
-    print(f"overlap = {overlap}")
-    print(f"subcube_size_pix = {subcube_size_pix}")
-    print(f"Number of subcubes = {num_subcubes}")
-    print(f"steps = {steps}")
+    if args.plan:
+        pixel_overlap, channel_overlap = read_sofia_overlaps(args.parfile)
+        min_chunks = int(np.ceil(int(args.cores)/int(args.threads)))
+        num_x, num_y, num_slabs = plan_chunks(wcs.array_shape,
+                                              float(args.mem_per_job),
+                                              bytes_per_voxel, min_chunks,
+                                              pixel_overlap, channel_overlap)
+        x_ranges = split_axis(wcs.array_shape[2], num_x)
+        y_ranges = split_axis(wcs.array_shape[1], num_y)
+        print(f"Planned grid = {num_x} x {num_y} x {num_slabs}")
+    else:
+        pixel_overlap = int(args.pixel_overlap)
+        num_slabs = int(args.num_slabs)
+        channel_overlap = int(args.channel_overlap)
+        if num_slabs > 1 and args.parfile is not None:
+            check_channel_overlap(channel_overlap, args.parfile)
+        x_ranges = y_ranges = regular_ranges(n_pix, int(args.num_subcubes))
 
-    coord_subcubes = write_subcubes(steps, wcs, overlap, subcube_size_pix,
-            coord_file=coord_file)
+    coord_subcubes = define_grid(wcs, x_ranges, y_ranges, pixel_overlap,
+                                 num_slabs, channel_overlap, coord_file,
+                                 resources_file=args.resources_file,
+                                 bytes_per_voxel=bytes_per_voxel,
+                                 threads=int(args.threads))
     plot_grid(wcs, coord_subcubes, grid_plot, n_pix)
 
 if __name__ == '__main__':
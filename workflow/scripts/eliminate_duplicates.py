@@ -18,11 +18,17 @@
 This script removes duplicates and creates a catalog without duplicated sources
 '''
 
+import sys
 import argparse
 import numpy as np
-from astropy.coordinates import SkyCoord
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from astropy import units as u
 from astropy.table import Table
+from split_subcube import read_coord_file
+from catalog_io import CATALOG_COLUMNS, is_columnar, read_catalog, \
+        write_catalog
 
 def get_args():
     '''This function parses and returns arguments passed in'''
@@ -32,6 +38,14 @@ def get_args():
                         help='catalog with duplicated sources')
     parser.add_argument('-o', '--outfile', dest='outfile',\
                         help='catalog without duplicated sources')
+    parser.add_argument('-c', '--coord', dest='coord_file', default=None, \
+                        help='File with edge coordinates of subcubes. If \
+                        given, duplicates must lie in the frequency range \
+                        of both subcubes')
+    parser.add_argument('-s', '--skip_match', dest='skip_match', \
+                        action='store_true', default=False, help='The \
+                        catalogs of the subcubes have already been \
+                        deduplicated, only sort and number the sources')
     args = parser.parse_args()
     return args
 
@@ -50,6 +64,8 @@ def read_ref_catalog(infile, name_list):
     catalog_table: astropy.Table
         table with the data
     '''
+    if is_columnar(infile):
+        return Table.from_pandas(read_catalog(infile)[name_list])
     catalog_table = Table.read(infile, format='ascii', delimiter=' ', \
                                names=name_list)
     return catalog_table
@@ -75,8 +91,13 @@ def read_coordinates_from_table(cat):
     freq = cat['central_freq']*u.Hz
     return ras, dec, freq
 
-def find_catalog_duplicates(ras, dec, freq):
-    '''Finds duplicates in the catalog
+def find_catalog_duplicates(ras, dec, freq, max_sep=3*u.arcsec,
+                            max_freq=20*u.MHz):
+    '''Finds all the pairs of sources closer than `max_sep` in the sky and
+    `max_freq` in frequency. The sources are placed in a KD-tree over their
+    unit vectors and their frequency, scaled so that `max_freq` corresponds
+    to the chord of `max_sep`, and the candidate pairs are then checked
+    against both tolerances
 
     Parameters
     ----------
@@ -86,32 +107,97 @@ def find_catalog_duplicates(ras, dec, freq):
         Declination
     freq: float
         Frequency
+    max_sep: astropy.Quantity
+        Maximum separation in the sky
+    max_freq: astropy.Quantity
+        Maximum separation in frequency
     Returns
     -------
-    cond: Bool array
-        array storing proximity criteria
-    idx: int array
-         Index of the duplicated sources
+    pairs: int array
+        array of shape (n_pairs, 2) with the indices of the duplicated
+        sources, each pair once and sorted
     '''
-    coord = SkyCoord(ra=ras, dec=dec)
-    idx, d2d, _ = coord.match_to_catalog_sky(coord, nthneighbor=2)
-    max_sep = 3 * u.arcsec
-    sep_constraint = d2d < max_sep
-    max_freq = 20 * u.MHz
-    freq_sep = abs(freq - freq[idx])
-    freq_constraint = freq_sep < max_freq
-    cond = sep_constraint * freq_constraint
-    return cond, idx
-
-def mask_worse_duplicates(cond, idx, catalog_table):
-    '''Finds worse duplicates and masks them
+    ra_rad = np.asarray(ras.to_value(u.rad), dtype=float)
+    dec_rad = np.asarray(dec.to_value(u.rad), dtype=float)
+    xyz = np.column_stack([np.cos(dec_rad)*np.cos(ra_rad),
+                           np.cos(dec_rad)*np.sin(ra_rad),
+                           np.sin(dec_rad)])
+    chord = 2*np.sin(max_sep.to_value(u.rad)/2)
+    freq_hz = np.asarray(freq.to_value(u.Hz), dtype=float)
+    scaled_freq = freq_hz*chord/max_freq.to_value(u.Hz)
+    tree = cKDTree(np.column_stack([xyz, scaled_freq]))
+    pairs = tree.query_pairs(np.sqrt(2)*chord, output_type='ndarray')
+    pairs = np.sort(pairs.reshape(-1, 2), axis=1)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    i, j = pairs.T
+    sep_constraint = np.linalg.norm(xyz[i] - xyz[j], axis=1) < chord
+    freq_constraint = np.abs(freq_hz[i] - freq_hz[j]) < max_freq.to_value(u.Hz)
+    return pairs[sep_constraint & freq_constraint]
+
+def restrict_to_spectral_overlap(pairs, catalog_table, coord_subcubes,
+                                 max_freq=20e6):
+    '''Keeps only the pairs of duplicates with both sources inside the
+    frequency range of the subcubes where they were detected. Sources from
+    different frequency slabs can only be duplicates in the channel overlap
+    of the slabs
+
+    Parameters
+    ----------
+    pairs: int array
+        array with the indices of the duplicated sources
+    catalog_table: astropy.Table
+        table with detections
+    coord_subcubes: array
+        Array containing coordinates of subcubes, including the frequency
+        range `zlo`, `zhi` of each subcube in Hz
+    max_freq: float
+        Tolerance in Hz at the edges of the frequency ranges
+    Returns
+    -------
+    pairs: int array
+        array with the indices of the duplicated sources
+    '''
+    subcube = np.array(catalog_table['subcube'], dtype=int)
+    freq = np.array(catalog_table['central_freq'], dtype=float)
+    f_lo = np.minimum(coord_subcubes['zlo'], coord_subcubes['zhi']) - max_freq
+    f_hi = np.maximum(coord_subcubes['zlo'], coord_subcubes['zhi']) + max_freq
+    def in_range(sources, subcubes):
+        return (freq[sources] >= f_lo[subcubes]) & \
+               (freq[sources] <= f_hi[subcubes])
+    i, j = pairs.T
+    overlap = in_range(i, subcube[j]) & in_range(j, subcube[i])
+    return pairs[overlap]
+
+def group_duplicates(pairs, n_sources):
+    '''Groups the sources connected by pairs of duplicates
+
+    Parameters
+    ----------
+    pairs: int array
+        array with the indices of the duplicated sources
+    n_sources: int
+        Number of sources in the catalog
+    Returns
+    -------
+    labels: int array
+        Label of the group of each source. Sources without duplicates are
+        alone in their group
+    '''
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_sources, n_sources))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+def mask_worse_duplicates(pairs, catalog_table):
+    '''Finds worse duplicates and masks them. In each group of duplicated
+    sources, the source with the lowest rms is kept. Ties are resolved by
+    subcube and id within the subcube, so the choice does not depend on the
+    order of the catalog
 
     Parameters
     ----------
-    cond: Bool array
-        array storing proximity criteria
-    idx: int array
-         Index of the duplicated sources
+    pairs: int array
+        array with the indices of the duplicated sources
     catalog_table: astropy.Table
         table with detections
     Returns
@@ -119,43 +205,56 @@ def mask_worse_duplicates(cond, idx, catalog_table):
     duplicates: Bool array
         array with True when source is duplicated
     '''
-    duplicates = np.copy(cond)
-    print('id1 subcube1 id_subcube1 rms1 id2 subcube2 id_subcube2 rms2')
-    # Here we are counting all matches twice.
-    # We could directly use the first half of the matches
-    for i in np.where(cond)[0]:
-        id1 = catalog_table[idx[i]]['id_subcube']
-        id2 = catalog_table[i]['id_subcube']
-        rms1 = catalog_table[idx[i]]['rms']
-        rms2 = catalog_table[i]['rms']
-        subcube1 = catalog_table[idx[i]]['subcube']
-        subcube2 = catalog_table[i]['subcube']
-        print(f"{idx[i]:2d} {subcube1} {id1} {rms1} {i} {subcube2} {id2} {rms2}")
-        if catalog_table[idx[i]]['rms'] < catalog_table[i]['rms']:
-            duplicates[idx[i]] = False
-        else:
-            duplicates[i] = False
-    print(f'Total number of duplicated sources: {int(len(np.where(cond)[0])/2)}')
+    n_sources = len(catalog_table)
+    labels = group_duplicates(pairs, n_sources)
+    rms = np.asarray(catalog_table['rms'])
+    id_subcube = np.asarray(catalog_table['id_subcube'])
+    subcube = np.asarray(catalog_table['subcube'])
+    order = np.lexsort((id_subcube, subcube, rms, labels))
+    first = np.ones(n_sources, dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    duplicates = np.ones(n_sources, dtype=bool)
+    duplicates[order[first]] = False
+    i, j = pairs.T
+    lines = [f"{i1:2d} {s1} {id1} {rms1} {i2} {s2} {id2} {rms2}\n"
+             for i1, s1, id1, rms1, i2, s2, id2, rms2 in zip(
+                 i.tolist(), subcube[i].tolist(), id_subcube[i].tolist(),
+                 rms[i].tolist(), j.tolist(), subcube[j].tolist(),
+                 id_subcube[j].tolist(), rms[j].tolist())]
+    sys.stdout.write('id1 subcube1 id_subcube1 rms1 id2 subcube2 id_subcube2 '
+                     'rms2\n' + ''.join(lines))
+    n_groups = len(np.unique(labels[np.unique(pairs)]))
+    print(f'Total number of duplicated pairs: {len(pairs)}, in {n_groups} '
+          f'groups')
+    print(f'Total number of duplicated sources: {np.count_nonzero(duplicates)}')
     return duplicates
 
 
 def main():
     '''Removes duplicates and creates a catalog without duplicated sources'''
     args = get_args()
-    name_list = ['id_subcube', 'ra', 'dec', 'hi_size', 'line_flux_integral', \
-                 'central_freq', 'pa', 'i', 'w20', 'rms', 'subcube']
+    name_list = CATALOG_COLUMNS
     catalog_table = read_ref_catalog(args.infile, name_list=name_list)
-    ras, dec, freq = read_coordinates_from_table(catalog_table)
-    cond, idx = find_catalog_duplicates(ras, dec, freq)
-    duplicates = mask_worse_duplicates(cond, idx, catalog_table)
+    if args.skip_match:
+        duplicates = np.zeros(len(catalog_table), dtype=bool)
+    else:
+        ras, dec, freq = read_coordinates_from_table(catalog_table)
+        pairs = find_catalog_duplicates(ras, dec, freq)
+        if args.coord_file is not None:
+            pairs = restrict_to_spectral_overlap(
+                pairs, catalog_table, read_coord_file(args.coord_file))
+        duplicates = mask_worse_duplicates(pairs, catalog_table)
     final_table = catalog_table[~duplicates][name_list[:-1]]
     final_table.sort(['ra', 'dec'])
     final_table['id'] = range(len(final_table))
     name_list_out = ['id', 'ra', 'dec', 'hi_size', 'line_flux_integral', \
                      'central_freq', 'pa', 'i', 'w20']
     final_table = final_table[name_list_out]
-    final_table.write(args.outfile, names=name_list_out, format='ascii', \
-                      overwrite=True)
+    if is_columnar(args.outfile):
+        write_catalog(final_table.to_pandas(), args.outfile)
+    else:
+        final_table.write(args.outfile, names=name_list_out, format='ascii', \
+                          overwrite=True)
 
 
 if __name__ == '__main__':
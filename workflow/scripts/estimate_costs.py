@@ -0,0 +1,149 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script estimates the cost of processing each subcube with Sofia, and
+the threads and memory of the corresponding jobs
+'''
+
+import argparse
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from split_subcube import read_coord_file, PIXEL_KEYS
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Estimate the processing cost of each subcube'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--datacube', dest='datacube', \
+                        help='Data cube to process.')
+    parser.add_argument('-c', '--coord', dest='coord_file', \
+                        help='File with edge coordinates of subcubes')
+    parser.add_argument('-o', '--output', dest='costs_file', \
+                        help='Output file with the cost of each subcube')
+    parser.add_argument('-s', '--stride', dest='stride', type=int, \
+                        default=8, help='Sampling stride along each axis \
+                        used to compute the statistics')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, \
+                        default=1, help='Threads given to the most \
+                        expensive subcube')
+    parser.add_argument('-b', '--bytes_per_voxel', dest='bytes_per_voxel', \
+                        type=float, default=16, help='Memory used by Sofia \
+                        per voxel of a subcube, in bytes')
+    parser.add_argument('-w', '--source_weight', dest='source_weight', \
+                        type=float, default=10, help='Relative cost of \
+                        voxels with emission compared to noise voxels')
+    args = parser.parse_args()
+    return args
+
+def sample_statistics(sample):
+    '''Returns the statistics of a sample of voxels of a subcube
+
+    Parameters
+    ----------
+    sample: array
+        Voxels sampled from the subcube
+    Returns
+    -------
+    nan_fraction: float
+        Fraction of blank voxels
+    rms: float
+        Robust estimate of the noise, from the median absolute deviation
+    bright_fraction: float
+        Fraction of valid voxels above 5 times the noise
+    '''
+    finite = sample[np.isfinite(sample)]
+    if finite.size == 0:
+        return 1., 0., 0.
+    nan_fraction = 1. - finite.size/sample.size
+    rms = 1.4826*np.median(np.abs(finite - np.median(finite)))
+    bright_fraction = np.count_nonzero(finite > 5*rms)/finite.size
+    return nan_fraction, rms, bright_fraction
+
+def estimate_costs(infile, coord_subcubes, stride=8, source_weight=10):
+    '''Estimates the cost of every subcube from its number of valid voxels,
+    weighting up the voxels with emission, which are the ones that Sofia
+    links and parameterises
+
+    Parameters
+    ----------
+    infile: str
+        Input file name
+    coord_subcubes: structured array
+        Coordinates and pixel bounds of the subcubes
+    stride: int
+        Sampling stride along each axis
+    source_weight: float
+        Relative cost of voxels with emission compared to noise voxels
+    Returns
+    -------
+    costs: pandas DataFrame
+        Table with one row per subcube
+    '''
+    rows = []
+    with fits.open(infile, memmap=True, do_not_scale_image_data=True) as hdul:
+        data = hdul[0].data
+        for idx, cidx in enumerate(coord_subcubes):
+            x0, x1, y0, y1, z0, z1 = (int(cidx[key]) for key in PIXEL_KEYS)
+            sample = np.asarray(data[z0:z1:stride, y0:y1:stride,
+                                     x0:x1:stride], dtype=float)
+            nan_fraction, rms, bright_fraction = sample_statistics(sample)
+            voxels = (x1 - x0)*(y1 - y0)*(z1 - z0)
+            cost = voxels*(1 - nan_fraction)*(1 + source_weight*bright_fraction)
+            rows.append([idx, voxels, nan_fraction, rms, bright_fraction, cost])
+            print(f"Subcube {idx}: voxels = {voxels}, "
+                  f"nan_fraction = {nan_fraction:.3f}, rms = {rms:.3g}, "
+                  f"cost = {cost:.4g}")
+    return pd.DataFrame(rows, columns=['idx', 'voxels', 'nan_fraction', 'rms',
+                                       'bright_fraction', 'cost'])
+
+def assign_resources(costs, threads, bytes_per_voxel):
+    '''Adds the threads and memory of each job to the cost table. Threads
+    are proportional to the cost, so that the most expensive subcube gets
+    `threads` and small subcubes can run side by side
+
+    Parameters
+    ----------
+    costs: pandas DataFrame
+        Table with the cost of each subcube
+    threads: int
+        Threads given to the most expensive subcube
+    bytes_per_voxel: float
+        Memory used by Sofia per voxel of a subcube, in bytes
+    Returns
+    -------
+    costs: pandas DataFrame
+        Table with the columns threads and mem_mb added
+    '''
+    max_cost = max(costs['cost'].max(), 1)
+    costs['threads'] = np.clip(np.ceil(threads*costs['cost']/max_cost),
+                               1, threads).astype(int)
+    costs['mem_mb'] = np.ceil(costs['voxels']*bytes_per_voxel/2**20).astype(int)
+    return costs
+
+def main():
+    '''Estimate the processing cost of each subcube'''
+    args = get_args()
+    coord_subcubes = read_coord_file(args.coord_file)
+    costs = estimate_costs(args.datacube, coord_subcubes, stride=args.stride,
+                           source_weight=args.source_weight)
+    costs = assign_resources(costs, args.threads, args.bytes_per_voxel)
+    costs.to_csv(args.costs_file, index=False, float_format='%g')
+    print(costs.sort_values('cost', ascending=False).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
@@ -18,12 +18,24 @@
 This script filters the output catalog based on some conditions
 '''
 
+import os
 import argparse
+from functools import lru_cache
 import numpy as np
+from scipy.interpolate import CubicSpline
 from astropy import constants as const
 from astropy.cosmology import FlatLambdaCDM
 import astropy.units as u
-import pandas as pd
+from catalog_io import read_catalog
+
+H0 = 70         # km/s/Mpc
+OM0 = 0.3
+F0_HI = 1420405751.786    # Hz
+CSPEED = const.c.value/1000      # km/s
+# Redshift step of the table of angular diameter distances, and maximum
+# relative error of its interpolation
+Z_STEP = 1e-3
+DA_RTOL = 1e-9
 
 def get_args():
     '''This function parses and returns arguments passed in'''
@@ -36,12 +48,83 @@ def get_args():
     args = parser.parse_args()
     return args
 
+@lru_cache(maxsize=None)
+def distance_table(z_min, z_max, z_step=Z_STEP, rtol=DA_RTOL):
+    '''Builds a cubic spline of the angular diameter distance divided by the
+    redshift over a range of redshifts. The ratio tends to c/H0 at redshift
+    0, so its relative error stays bounded where the distance goes to zero.
+    The cosmology is evaluated once per table, and the spline is checked
+    against it halfway between the nodes
+
+    Parameters
+    ----------
+    z_min: float
+        Minimum redshift
+    z_max: float
+        Maximum redshift
+    z_step: float
+        Redshift step between the nodes of the table
+    rtol: float
+        Maximum relative error of the interpolated distances
+    Returns
+    -------
+    ratio_spline: scipy.interpolate.CubicSpline
+        angular diameter distance in kpc divided by the redshift, as a
+        function of redshift
+    '''
+    cosmo = FlatLambdaCDM(H0=H0, Om0=OM0)
+    def distance_ratio(redshift):
+        d_a = cosmo.angular_diameter_distance(redshift).to_value(u.kpc)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(redshift == 0, CSPEED/H0*1000, d_a/redshift)
+    # Nodes at whole steps, so that redshift 0 is a node when it is covered
+    first = int(round(z_min/z_step))
+    last = max(int(round(z_max/z_step)), first + 1)
+    redshift = z_step*np.arange(first, last + 1)
+    ratio_spline = CubicSpline(redshift, distance_ratio(redshift))
+    z_mid = (redshift[1:] + redshift[:-1])/2
+    error = np.max(np.abs(ratio_spline(z_mid)/distance_ratio(z_mid) - 1),
+                   initial=0)
+    if error > rtol:
+        raise ValueError(f'Relative error {error:.2e} of the interpolated '
+                         f'distances above {rtol:.2e}. Reduce the redshift '
+                         f'step {z_step}')
+    return ratio_spline
+
+def angular_diameter_distance(redshift, z_step=Z_STEP):
+    '''Returns the angular diameter distance interpolated from a table
+    covering the redshifts given, rounded outwards to whole steps so that
+    the table is reused for similar ranges, and extended by two steps on
+    each side so that the spline has enough nodes for a single redshift
+
+    Parameters
+    ----------
+    redshift: array of floats
+        redshift
+    z_step: float
+        Redshift step between the nodes of the table
+    Returns
+    -------
+    d_a: array of floats
+        angular diameter distance in kpc, NaN for non-finite redshifts
+    '''
+    redshift = np.asarray(redshift, dtype=float)
+    finite = np.isfinite(redshift)
+    d_a = np.full(redshift.shape, np.nan)
+    if not finite.any():
+        return d_a
+    z_min = (np.floor(np.nanmin(redshift[finite])/z_step) - 2)*z_step
+    z_max = (np.ceil(np.nanmax(redshift[finite])/z_step) + 2)*z_step
+    d_a[finite] = distance_table(round(z_min, 12), round(z_max, 12),
+                                 z_step)(redshift[finite])*redshift[finite]
+    return d_a
+
 def arcsec2kpc(redshift, theta):
     '''Converts angular size to linear size given a redshift
 
     Parameters
     ----------
-    redshift: float
+    redshift: array of floats
         redshift
     theta: array of floats
         angular size in arcsec
@@ -50,10 +133,8 @@ def arcsec2kpc(redshift, theta):
     distance_kpc: array of floats
         linear size in kpc
     '''
-    cosmo = FlatLambdaCDM(H0=70, Om0=0.3)
-    d_a = cosmo.angular_diameter_distance(z=redshift)
-    distance_kpc = (theta*u.arcsec * d_a).to(u.kpc, u.dimensionless_angles())
-    return distance_kpc
+    return np.radians(np.asarray(theta)/3600.)*\
+           angular_diameter_distance(redshift)
 
 def compute_d_m(cat):
     '''Computes the Mass of HI and linear diameter of the galaxies in a catalog
@@ -67,23 +148,19 @@ def compute_d_m(cat):
     cat: pandas.DataFrame
         original catalog adding the columns log(M_HI) and log(D_HI_kpc)
     '''
-    cspeed = const.c.value/1000      # km/s
-    h_small = 0.7
-    f0_hi = 1420405751.786
-    size = cat['hi_size'] # arcsec
-    redshift = (f0_hi-cat['central_freq'])/cat['central_freq']
-    distance_kpc = arcsec2kpc(redshift.values, size.values)
+    h_small = H0/100.
+    size = cat['hi_size'].to_numpy(dtype=float) # arcsec
+    central_freq = cat['central_freq'].to_numpy(dtype=float)
+    redshift = (F0_HI-central_freq)/central_freq
+    distance_kpc = arcsec2kpc(redshift, size)
 
     # Equation (37) of https://arxiv.org/pdf/1705.04210.pdf
-    flux_jy_km_s = cat['line_flux_integral']*(cspeed*(1+redshift)**2)/f0_hi
-    vel = (cat['central_freq'].values * u.Hz).to(u.km / u.s,
-           equivalencies=freq_to_vel())
-    distance_mpc = vel/70
-    m_hi_units = (1/h_small**2)*235600*flux_jy_km_s*(distance_mpc*h_small)**2
-    d_hi_kpc = np.array(distance_kpc)
-    m_hi = np.array(m_hi_units)
+    flux_jy_km_s = cat['line_flux_integral'].to_numpy(dtype=float)*\
+                   (CSPEED*(1+redshift)**2)/F0_HI
+    distance_mpc = freq_to_vel(central_freq)/H0
+    m_hi = (1/h_small**2)*235600*flux_jy_km_s*(distance_mpc*h_small)**2
     cat['logM'] = np.log10(m_hi)
-    cat['logD'] = np.log10(d_hi_kpc)
+    cat['logD'] = np.log10(distance_kpc)
     return cat
 
 def filter_md(df_md, uplim=0.45, downlim=-0.15):
@@ -110,29 +187,30 @@ def filter_md(df_md, uplim=0.45, downlim=-0.15):
     df_out = df_md[~cond]
     return df_out
 
-def freq_to_vel(f0_hi=1420405751.786):
-    '''Convers line frequency to velocity in km/s
+def freq_to_vel(freq, f0_hi=F0_HI):
+    '''Converts line frequency to velocity in km/s, with the radio
+    definition of the Doppler shift
 
     Parameters
     ----------
+    freq: array of floats
+        frequency in Hz
     f0_hi: float
         rest frequency of the spectral line
     Returns
     -------
-    freq2vel: function
-        function to convert frequency in Hz to velocity
+    vel: array of floats
+        velocity in km/s
     '''
-    restfreq = f0_hi * u.Hz
-    freq2vel = u.doppler_radio(restfreq)
-    return freq2vel
+    return CSPEED*(1 - np.asarray(freq)/f0_hi)
 
 def main():
     '''Gets an input catalog and filters the sources based on deviation
     from the D_HI M_HI correlation'''
     args = get_args()
-    dataf = pd.read_csv(args.infile, delimiter=' ')
+    dataf = read_catalog(args.infile)
     dataf_md = compute_d_m(dataf)
-    dataf_md_file = (args.infile).replace('.csv', '_logMD.csv')
+    dataf_md_file = os.path.splitext(args.infile)[0] + '_logMD.csv'
     dataf_md.to_csv(dataf_md_file, sep=' ', index=False)
     # Filter based of correlation
     dataf_filtered = filter_md(dataf_md)
@@ -0,0 +1,222 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script measures the noise of each channel of the full data cube once,
+with the same statistic as the spectral noise scaling of Sofia, so that the
+subcubes are normalised by the same noise instead of measuring it on each
+subcube
+'''
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.io import fits
+
+# Conversion from median absolute deviation to standard deviation
+MAD_TO_STD = 1.482602218505602
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Measure the noise of each channel of the data cube'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--datacube', dest='datacube', \
+                        help='Data cube to process.')
+    parser.add_argument('-p', '--parfile', dest='parfile', \
+                        default='config/sofia_12.par', help='Sofia \
+                        parameters file, with the statistic and flux range \
+                        of the noise scaling')
+    parser.add_argument('-o', '--output', dest='noise_file', \
+                        help='Output file with the noise of each channel')
+    parser.add_argument('-n', '--noise_cube', dest='noise_cube', \
+                        default=None, help='Output noise cube with the \
+                        dimensions of the data cube. Default is not to \
+                        write it')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, \
+                        default=1, help='Number of slabs processed at once')
+    parser.add_argument('-s', '--slab', dest='slab', type=int, \
+                        help='Number of channels read at once', default=16)
+    args = parser.parse_args()
+    return args
+
+def read_noise_parameters(parfile):
+    '''Returns the statistic and the flux range of the noise scaling of Sofia
+
+    Parameters
+    ----------
+    parfile: str
+        Sofia parameters file
+    Returns
+    -------
+    statistic: str
+        `std`, `mad` or `gauss`
+    flux_range: str
+        `negative`, `positive` or `full`
+    '''
+    params = {}
+    with open(parfile, 'r') as infile:
+        for line in infile.readlines():
+            if '=' in line and not line.strip().startswith('#'):
+                key, value = line.split('=', 1)
+                params[key.strip()] = value.split('#')[0].strip()
+    mode = params.get('scaleNoise.mode', 'spectral')
+    if mode != 'spectral':
+        print(f'Warning: Sofia uses the noise scaling mode {mode}, the noise '
+              'is measured per channel instead')
+    return (params.get('scaleNoise.statistic', 'mad'),
+            params.get('scaleNoise.fluxRange', 'negative'))
+
+def channel_noise(plane, statistic='mad', flux_range='negative'):
+    '''Measures the noise of a channel as Sofia does, about zero and using
+    only the pixels in the flux range
+
+    Parameters
+    ----------
+    plane: array
+        Pixels of the channel
+    statistic: str
+        `std`, `mad` or `gauss`. The gaussian fit of Sofia is approximated by
+        the median absolute deviation
+    flux_range: str
+        `negative`, `positive` or `full`
+    Returns
+    -------
+    noise: float
+        Noise of the channel, NaN if it has no valid pixels
+    '''
+    values = plane[np.isfinite(plane)]
+    if flux_range == 'negative':
+        values = values[values < 0]
+    elif flux_range == 'positive':
+        values = values[values > 0]
+    if values.size == 0:
+        return np.nan
+    if statistic == 'std':
+        return float(np.sqrt(np.mean(np.square(values, dtype=np.float64))))
+    return MAD_TO_STD*float(np.median(np.abs(values)))
+
+def measure_noise(infile, statistic='mad', flux_range='negative', threads=1,
+                  slab=16):
+    '''Measures the noise of every channel of a data cube, reading slabs of
+    channels from the memory-mapped cube in parallel threads
+
+    Parameters
+    ----------
+    infile: str
+        Data cube
+    statistic: str
+        `std`, `mad` or `gauss`
+    flux_range: str
+        `negative`, `positive` or `full`
+    threads: int
+        Number of slabs processed at once
+    slab: int
+        Number of channels read at once
+    Returns
+    -------
+    noise: array
+        Noise of each channel
+    '''
+    with fits.open(infile, memmap=True) as hdul:
+        data = hdul[0].data
+        def slab_noise(k_0):
+            planes = np.asarray(data[k_0:k_0+slab])
+            return [channel_noise(plane, statistic, flux_range)
+                    for plane in planes]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            noise = [value for values in
+                     executor.map(slab_noise, range(0, data.shape[0], slab))
+                     for value in values]
+    return np.array(noise)
+
+def write_channel_noise(noise, noise_file):
+    '''Writes the noise of each channel
+
+    Parameters
+    ----------
+    noise: array
+        Noise of each channel
+    noise_file: str
+        Output file
+    '''
+    np.savetxt(noise_file, np.column_stack([np.arange(len(noise)), noise]),
+               fmt=['%d', '%.9g'], delimiter=',', header='channel,noise',
+               comments='')
+
+def read_channel_noise(noise_file):
+    '''Reads the noise of each channel
+
+    Parameters
+    ----------
+    noise_file: str
+        File with the noise of each channel
+    Returns
+    -------
+    noise: array
+        Noise of each channel
+    '''
+    table = np.genfromtxt(noise_file, delimiter=',', names=True)
+    return np.atleast_1d(table['noise'])
+
+def write_noise_cube(outfile, header, noise, slab=16):
+    '''Writes a noise cube for Sofia, in which every pixel of a channel has
+    the noise of the channel, one slab of channels at a time
+
+    Parameters
+    ----------
+    outfile: str
+        Output noise cube
+    header: astropy.io.fits.Header
+        Header of the data cube normalised by the noise cube
+    noise: array
+        Noise of each channel of the data cube
+    slab: int
+        Number of channels written at once
+    '''
+    noise_header = header.copy()
+    noise_header['BITPIX'] = -32
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        noise_header.remove(key, ignore_missing=True)
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    # StreamingHDU appends a new extension to existing files
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+    stream = fits.StreamingHDU(outfile, noise_header)
+    for k_0 in range(0, len(noise), slab):
+        values = noise[k_0:k_0+slab].astype(np.float32)
+        stream.write(np.ascontiguousarray(np.broadcast_to(
+            values[:, None, None], values.shape + shape)))
+    stream.close()
+
+def main():
+    '''Measures the noise of each channel of the data cube'''
+    args = get_args()
+    statistic, flux_range = read_noise_parameters(args.parfile)
+    print(f'Measuring the noise per channel with statistic {statistic} '
+          f'and flux range {flux_range}')
+    noise = measure_noise(args.datacube, statistic, flux_range,
+                          threads=args.threads, slab=args.slab)
+    write_channel_noise(noise, args.noise_file)
+    print(f'Noise per channel between {np.nanmin(noise)} and '
+          f'{np.nanmax(noise)}, {np.count_nonzero(np.isnan(noise))} blank '
+          'channels')
+    if args.noise_cube is not None:
+        write_noise_cube(args.noise_cube, fits.getheader(args.datacube),
+                         noise, slab=args.slab)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script collects the benchmark files written by Snakemake for each job of
+the workflow in a single table, and plots the resources used by the jobs of
+each subcube
+'''
+
+import os
+import re
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Columns of the Snakemake benchmark files included in the report
+BENCHMARK_COLUMNS = ['s', 'cpu_time', 'max_rss', 'max_uss', 'io_in', 'io_out',
+                     'mean_load']
+# Rules that run with more than one thread
+MULTITHREADED_RULES = ['run_sofia', 'sofia2cat_batch', 'global_noise',
+                       'process_chunk', 'sofia_sweep']
+# Rules whose threads are given per subcube by the table of resources
+SCALED_RULES = ['run_sofia', 'process_chunk']
+# Stages of the processing of each subcube, in order of execution
+CHUNK_STAGES = ['split_subcube', 'run_sofia', 'sofia2cat', 'process_chunk',
+                'deduplicate_subcube']
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Summarize the resources used by the jobs of the workflow'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', \
+                        default='results/benchmarks', help='Directory with \
+                        the benchmark files of the rules')
+    parser.add_argument('-o', '--outfile', dest='outfile', \
+                        default='summary/performance.csv', help='Output \
+                        table with one row per job')
+    parser.add_argument('-p', '--plot', dest='plot', \
+                        default='summary/performance.png', help='Plot of the \
+                        resources used for each subcube')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, \
+                        default=1, help='Threads of the multithreaded rules')
+    parser.add_argument('-r', '--resources', dest='resources_file', \
+                        default=None, help='Table with the threads of each \
+                        subcube, from define_chunks or estimate_costs')
+    args = parser.parse_args()
+    return args
+
+def read_benchmark(filename):
+    '''Reads a Snakemake benchmark file, and finds the rule and the subcube
+    of the job from its path: `{rule}/subcube_{idx}.tsv` for the jobs of one
+    subcube and `{stage}/{rule}.tsv` otherwise
+
+    Parameters
+    ----------
+    filename: str
+        Benchmark file
+    Returns
+    -------
+    bench: pandas.DataFrame
+        Benchmark of the job, with the columns `rule` and `idx` added. The
+        file has more than one row if the job was repeated
+    '''
+    bench = pd.read_csv(filename, sep='\t')
+    name = os.path.splitext(os.path.basename(filename))[0]
+    match = re.fullmatch(r'subcube_(\d+)', name)
+    if match:
+        bench['rule'] = os.path.basename(os.path.dirname(filename))
+        bench['idx'] = int(match.group(1))
+    else:
+        bench['rule'] = name
+        bench['idx'] = -1
+    return bench
+
+def job_threads(perf, threads=1, resources_file=None):
+    '''Returns the threads of each job. Multithreaded rules use `threads`,
+    and the rules scaled per subcube use the threads of each subcube in
+    `resources_file` when given
+
+    Parameters
+    ----------
+    perf: pandas.DataFrame
+        Table with one row per job
+    threads: int
+        Threads of the multithreaded rules
+    resources_file: str
+        Table with the threads of each subcube
+    Returns
+    -------
+    n_threads: array of int
+        Threads of each job
+    '''
+    multithreaded = perf['rule'].isin(MULTITHREADED_RULES).to_numpy()
+    n_threads = np.where(multithreaded, threads, 1)
+    if resources_file is not None and os.path.isfile(resources_file):
+        resources = pd.read_csv(resources_file, index_col='idx')
+        if 'threads' in resources:
+            chunk_threads = perf['idx'].map(resources['threads']).to_numpy()
+            per_chunk = perf['rule'].isin(SCALED_RULES).to_numpy() & \
+                        ~np.isnan(chunk_threads)
+            n_threads[per_chunk] = chunk_threads[per_chunk]
+    return n_threads
+
+def performance_table(benchmark_dir, threads=1, resources_file=None):
+    '''Builds a table with the resources used by each job
+
+    Parameters
+    ----------
+    benchmark_dir: str
+        Directory with the benchmark files of the rules
+    threads: int
+        Threads of the multithreaded rules
+    resources_file: str
+        Table with the threads of each subcube
+    Returns
+    -------
+    perf: pandas.DataFrame
+        Table with one row per job, with the wall time, cpu time, peak memory
+        and I/O of the job, and the fraction of its threads that were busy
+    '''
+    files = sorted(glob.glob(os.path.join(benchmark_dir, '**', '*.tsv'),
+                             recursive=True))
+    if not files:
+        raise ValueError(f'No benchmark files found in {benchmark_dir}')
+    perf = pd.concat([read_benchmark(filename) for filename in files],
+                     ignore_index=True)
+    perf = perf[['rule', 'idx'] + [column for column in BENCHMARK_COLUMNS
+                                   if column in perf]]
+    perf['threads'] = job_threads(perf, threads, resources_file)
+    if 'cpu_time' in perf:
+        perf['thread_utilisation'] = perf['cpu_time'] / \
+                                     (perf['s'].clip(lower=1e-3) *
+                                      perf['threads'])
+    return perf.sort_values(['idx', 'rule'], kind='stable')
+
+def plot_chunks(perf, plot_file):
+    '''Plots the wall time of each stage and the peak memory for each
+    subcube
+
+    Parameters
+    ----------
+    perf: pandas.DataFrame
+        Table with one row per job
+    plot_file: str
+        Output plot
+    '''
+    chunks = perf[perf['idx'] >= 0]
+    wall = chunks.pivot_table(index='idx', columns='rule', values='s',
+                              aggfunc='sum')
+    wall = wall[[stage for stage in CHUNK_STAGES if stage in wall] +
+                [rule for rule in wall if rule not in CHUNK_STAGES]]
+    rss = chunks.pivot_table(index='idx', columns='rule', values='max_rss',
+                             aggfunc='max')
+    fig, (ax_time, ax_rss) = plt.subplots(2, 1, sharex=True,
+                                          figsize=(max(6, len(wall)/4), 6))
+    wall.plot.bar(stacked=True, ax=ax_time)
+    ax_time.set_ylabel('Wall time [s]')
+    rss.plot.bar(ax=ax_rss, legend=False)
+    ax_rss.set_ylabel('Peak RSS [MB]')
+    ax_rss.set_xlabel('Subcube')
+    fig.savefig(plot_file, bbox_inches='tight', dpi=200)
+
+def main():
+    '''Summarizes the resources used by the jobs of the workflow'''
+    args = get_args()
+    perf = performance_table(args.benchmarks, threads=args.threads,
+                             resources_file=args.resources_file)
+    perf.to_csv(args.outfile, index=False)
+    print(perf.groupby('rule')[['s', 'max_rss']].agg(['sum', 'max']))
+    plot_chunks(perf, args.plot)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This script processes one subcube in a single job: it splits the subcube,
+runs Sofia and converts its catalog in a local scratch directory, and copies
+back only the final catalog
+'''
+
+import os
+import shutil
+import argparse
+import tempfile
+from split_subcube import read_coord_file, split_subcube, header_file
+from global_noise import read_channel_noise
+from run_sofia import run_sofia
+from sofia2cat import convert_catalog
+
+def get_args():
+    '''This function parses and returns arguments passed in'''
+    description = 'Process a subcube in a local scratch directory'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--index', dest='idx', type=int, \
+                        help='Subcube index')
+    parser.add_argument('-d', '--datacube', dest='datacube', \
+                        help='Data cube to process.')
+    parser.add_argument('-c', '--coord', dest='coord_file', \
+                        help='File with edge coordinates of subcubes')
+    parser.add_argument('-p', '--parfile', dest='parfile', \
+                        help='Sofia parameters file')
+    parser.add_argument('-r', '--results_path', dest='results_path', \
+                        default='results/sofia', help='Directory where the \
+                        catalog of the subcube is copied')
+    parser.add_argument('--scratch', dest='scratch', default=None, \
+                        help='Local scratch directory. Default is TMPDIR')
+    parser.add_argument('-s', '--scfind_threshold', dest='scfind_threshold', \
+                        help='Sofia parameter scfind_threshold')
+    parser.add_argument('-f', '--reliability_fmin', dest='reliability_fmin', \
+                        help='Sofia parameter reliability_fmin')
+    parser.add_argument('-t', '--reliability_threshold', \
+                        dest='reliability_threshold', help='Sofia parameter \
+                        reliability_threshold')
+    parser.add_argument('--threads', dest='threads', default=None, \
+                        help='Number of threads used by Sofia. Default is \
+                        the value in the parfile')
+    parser.add_argument('--format', dest='format', default='csv', \
+                        choices=['csv', 'parquet'], help='Format of the \
+                        final catalog')
+    parser.add_argument('--slabs', dest='slabs', action='store_true', \
+                        help='Remove the sources truncated by the edges of \
+                        the frequency slabs', default=False)
+    parser.add_argument('--virtual', dest='virtual', action='store_true', \
+                        help='Read the region of the subcube directly from \
+                        the data cube instead of splitting it', default=False)
+    parser.add_argument('--noise', dest='noise', default=None, \
+                        help='File with the noise of each channel or, with \
+                        --virtual, noise cube of the data cube')
+    parser.add_argument('--keep_cubelets', dest='keep_cubelets', \
+                        action='store_true', help='Copy back the cubelets \
+                        of the sources', default=False)
+    parser.add_argument('--cache_dir', dest='cache_dir', default=None, \
+                        help='Directory of the cache of Sofia products')
+    parser.add_argument('--cache_size', dest='cache_size', default=50, \
+                        help='Maximum size of the cache in GB')
+    args = parser.parse_args()
+    return args
+
+def process_chunk(idx, datacube, coord_file, parfile, results_path, scratch,
+                  sofia_params, fmt='csv', slabs=False, virtual=False,
+                  noise=None, keep_cubelets=False, **kwargs):
+    '''Splits a subcube, runs Sofia and converts its catalog in a scratch
+    directory, and copies back the final catalog
+
+    Parameters
+    ----------
+    idx: int
+        Index of subcube
+    datacube: str
+        Data cube to process
+    coord_file: str
+        File with edge coordinates of subcubes
+    parfile: str
+        Sofia parameters file
+    results_path: str
+        Directory where the catalog of the subcube is copied
+    scratch: str
+        Directory in which the temporary files are written
+    sofia_params: tuple of str
+        Sofia parameters scfind_threshold, reliability_fmin and
+        reliability_threshold
+    fmt: str
+        Format of the final catalog
+    slabs: bool
+        If True, sources truncated by the edges of frequency slabs are removed
+    virtual: bool
+        If True, Sofia reads the region of the subcube from the data cube
+    noise: str
+        File with the noise of each channel, or noise cube of the data cube
+        if `virtual`. Default is to let Sofia scale the noise
+    keep_cubelets: bool
+        If True, the cubelets of the sources are also copied back
+    **kwargs:
+        Other arguments of `run_sofia`
+    Returns
+    -------
+    final_cat_file: str
+        Path of the copied catalog
+    '''
+    coord_subcubes = read_coord_file(coord_file)
+    outname = str(idx)
+    local_path = os.path.join(scratch, 'sofia')
+    os.makedirs(local_path, exist_ok=True)
+    if virtual:
+        subcube = datacube
+        header = datacube
+        region = {'coord_file': coord_file, 'idx': idx}
+        noise_cube = noise
+    else:
+        channel_noise = None if noise is None else read_channel_noise(noise)
+        subcube = split_subcube(datacube, coord_subcubes, idx,
+                                noise=channel_noise, outdir=scratch)
+        header = header_file(subcube)
+        region = {}
+        noise_cube = None if noise is None else \
+                     os.path.join(scratch, f'noise_{idx}.fits')
+    run_sofia(parfile, outname, subcube, local_path, *sofia_params,
+              noise=noise_cube, **region, **kwargs)
+    local_catalog = os.path.join(local_path, outname,
+                                 f'subcube_{idx}_cat.txt')
+    local_final = convert_catalog(local_catalog, outname, header=header,
+                                  results_path=local_path, fmt=fmt,
+                                  coord_subcubes=coord_subcubes if slabs
+                                  else None)
+    output_path = os.path.join(results_path, outname)
+    os.makedirs(output_path, exist_ok=True)
+    if keep_cubelets:
+        cubelets = os.path.join(local_path, outname, f'subcube_{idx}_cubelets')
+        if os.path.isdir(cubelets):
+            shutil.copytree(cubelets, os.path.join(
+                output_path, os.path.basename(cubelets)), dirs_exist_ok=True)
+    final_cat_file = os.path.join(output_path, os.path.basename(local_final))
+    # Copied under a temporary name, so that an interrupted copy is not taken
+    # as the final catalog
+    shutil.copyfile(local_final, final_cat_file + '.part')
+    os.replace(final_cat_file + '.part', final_cat_file)
+    print(f'Final catalog copied to {final_cat_file}')
+    return final_cat_file
+
+def main():
+    '''Processes a subcube in a local scratch directory'''
+    args = get_args()
+    scratch = tempfile.mkdtemp(prefix=f'subcube_{args.idx}_',
+                               dir=args.scratch)
+    print(f'Scratch directory: {scratch}')
+    try:
+        process_chunk(args.idx, args.datacube, args.coord_file, args.parfile,
+                      args.results_path, scratch,
+                      (args.scfind_threshold, args.reliability_fmin,
+                       args.reliability_threshold),
+                      fmt=args.format, slabs=args.slabs,
+                      virtual=args.virtual, noise=args.noise,
+                      keep_cubelets=args.keep_cubelets,
+                      threads=args.threads, cache_dir=args.cache_dir,
+                      cache_size=args.cache_size)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
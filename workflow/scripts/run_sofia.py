@@ -19,9 +19,13 @@ This script runs Sofia *******
 '''
 import sys
 import os
+import re
 import argparse
 import subprocess
+from itertools import product
 from shutil import which
+from split_subcube import read_coord_file, PIXEL_KEYS
+import sofia_cache
 #import yaml
 
 # Functions
@@ -45,6 +49,32 @@ def get_args():
                         help='Define reliability_fmin parameter', default=6)
     parser.add_argument('-t', '--reliability_threshold', dest='reliability_threshold',
                         help='Define reliability_threshold parameter', default=0.4)
+    parser.add_argument('-c', '--coord', dest='coord_file', help='File with \
+                        edge coordinates of subcubes. If given, Sofia reads \
+                        the region of subcube `index` directly from the \
+                        data cube', default=None)
+    parser.add_argument('-i', '--index', dest='idx', help='Subcube index \
+                        used together with --coord', default=None)
+    parser.add_argument('--threads', dest='threads', help='Number of threads \
+                        used by Sofia. Default is the value in the parfile', \
+                        default=None)
+    parser.add_argument('--noise', dest='noise', help='Noise cube of the \
+                        data cube. When given, Sofia reads it through \
+                        input.noise instead of measuring the noise', \
+                        default=None)
+    parser.add_argument('--cache_dir', dest='cache_dir', help='Directory of \
+                        the cache of Sofia products, indexed by the \
+                        parameters, the version of Sofia and the contents \
+                        of the data cube. Default is not to use a cache', \
+                        default=None)
+    parser.add_argument('--cache_size', dest='cache_size', help='Maximum \
+                        size of the cache in GB. The least recently used \
+                        products are removed first', default=50)
+    parser.add_argument('--sweep', dest='sweep', action='store_true', \
+                        help='Run Sofia for a grid of parameters, given as \
+                        comma-separated lists of scfind_threshold, \
+                        reliability_fmin and reliability_threshold', \
+                        default=False)
     args = parser.parse_args()
     return args
 
@@ -52,9 +82,52 @@ def is_tool(name):
     """Check whether `name` is on PATH and marked as executable."""
     return which(name) is not None
 
+def set_parameter(lines, parameter, value):
+    '''Sets the value of a parameter in the contents of a Sofia parfile
+
+    Parameters
+    ----------
+    lines: str
+        Contents of the parfile
+    parameter: str
+        Name of the parameter, e.g. `input.region`
+    value: str
+        New value of the parameter
+    Returns
+    -------
+    lines: str
+        Contents of the parfile with the updated parameter
+    '''
+    pattern = re.compile(rf'^{re.escape(parameter)}\s*=.*$', re.MULTILINE)
+    new_line = f'{parameter:<27}=  {value}'
+    if pattern.search(lines):
+        return pattern.sub(new_line, lines)
+    return lines + f'\n{new_line}\n'
+
+def read_region(coord_file, idx):
+    '''Returns the pixel region of a subcube in the format of the Sofia
+    parameter `input.region`
+
+    Parameters
+    ----------
+    coord_file: str
+        File with edge coordinates of subcubes
+    idx: int
+        Index of subcube
+    Returns
+    -------
+    region: str
+        Pixel range x_min, x_max, y_min, y_max, z_min, z_max of the subcube
+    '''
+    x_0, x_1, y_0, y_1, z_0, z_1 = (int(read_coord_file(coord_file)[idx][key])
+                                    for key in PIXEL_KEYS)
+    # Sofia regions include the upper bound
+    return f'{x_0}, {x_1-1}, {y_0}, {y_1-1}, {z_0}, {z_1-1}'
+
 def update_parfile(parfile, output_path, datacube,
               scfind_threshold, reliability_fmin,
-              reliability_threshold):
+              reliability_threshold, region=None, datacube_name=None,
+              threads=None, parameters=None):
     '''Updates file with paramenters
 
     Parameters
@@ -65,8 +138,20 @@ def update_parfile(parfile, output_path, datacube,
         Path of output file
     datacube: str
         Path to datacube
-    outname: str
-        Name of output file
+    scfind_threshold: float
+        Sofia parameter scfind_threshold
+    reliability_fmin: float
+        Sofia parameter reliability_fmin
+    reliability_threshold: float
+        Sofia parameter reliability_threshold
+    region: str
+        Region of the datacube to process. Default is the whole cube
+    datacube_name: str
+        Name of the output products. Default is the name of the datacube
+    threads: int
+        Number of threads used by Sofia. Default is the value in `parfile`
+    parameters: dict
+        Other Sofia parameters to set, e.g. {'input.noise': 'noise.fits'}
     Returns
     -------
     updated_parfile: str
@@ -75,7 +160,8 @@ def update_parfile(parfile, output_path, datacube,
     updated_parfile = os.path.join(output_path, 'sofia.par')
     print(f'Updated parfile: {updated_parfile}')
     datacube_path = datacube
-    datacube_name = os.path.basename(datacube).rstrip('.fits')
+    if datacube_name is None:
+        datacube_name = os.path.basename(datacube).rstrip('.fits')
     with open(parfile, 'r') as filein, open(updated_parfile, 'w') as fileout:
         lines = filein.read().replace('output_path', output_path)
         lines= lines.replace('datacube', datacube_path)
@@ -83,6 +169,14 @@ def update_parfile(parfile, output_path, datacube,
         lines= lines.replace('scfind_threshold', scfind_threshold)
         lines= lines.replace('reliability_fmin', reliability_fmin)
         lines= lines.replace('reliability_threshold', reliability_threshold)
+        if region is not None:
+            lines = set_parameter(lines, 'input.region', region)
+            # Report pixel positions in the frame of the full data cube
+            lines = set_parameter(lines, 'parameter.offset', 'true')
+        if threads is not None:
+            lines = set_parameter(lines, 'pipeline.threads', threads)
+        for parameter, value in (parameters or {}).items():
+            lines = set_parameter(lines, parameter, value)
         fileout.write(lines)
     print(os.path.isfile(updated_parfile))
     return updated_parfile
@@ -109,8 +203,10 @@ def eliminate_time(cat):
 
 def run_sofia(parfile, outname, datacube, results_path,
               scfind_threshold, reliability_fmin,
-              reliability_threshold):
-    """Only runs Sofia if the output catalog  does not exist
+              reliability_threshold, coord_file=None, idx=None, threads=None,
+              noise=None, cache_dir=None, cache_size=50):
+    """Runs Sofia. With a cache, the products of an identical execution are
+    restored from the cache instead, and new products are stored in it
 
     Parameters
     ----------
@@ -128,40 +224,209 @@ def run_sofia(parfile, outname, datacube, results_path,
         Sofia parameter reliability_fmin
     reliability_threshold: float
         Sofia parameter reliability_threshold
+    coord_file: str
+        File with edge coordinates of subcubes. If given, only the region
+        of subcube `idx` of the data cube is processed
+    idx: int
+        Index of subcube
+    threads: int
+        Number of threads used by Sofia. Default is the value in `parfile`
+    noise: str
+        Noise cube read by Sofia instead of scaling the noise itself. With
+        `coord_file` the same region is read from it
+    cache_dir: str
+        Directory of the cache of Sofia products. Default is not to use it
+    cache_size: float
+        Maximum size of the cache in GB
     """
-    #It makes sense to not run this when the results exist but maybe a check
-    #on an existing catalog is better
     output_path = os.path.join(results_path, outname)
-    datacube_name = os.path.basename(datacube).replace('.fits','')
+    if coord_file is not None:
+        region = read_region(coord_file, int(idx))
+        datacube_name = f'subcube_{idx}'
+        print(f'Processing region {region} of {datacube}')
+    else:
+        region = None
+        datacube_name = os.path.basename(datacube).replace('.fits','')
     output_catalog = os.path.join(output_path, f'{datacube_name}_cat.txt')
     if not os.path.isdir(output_path):
         os.mkdir(output_path)
-    if not os.path.isfile(output_catalog):
-        print(f'Parfile: {parfile}')
-        updated_parfile = update_parfile(parfile, output_path, datacube,
-              scfind_threshold, reliability_fmin,
-              reliability_threshold)
-        if is_tool('sofia'):
-            print('Executing Sofia-2')
-            subprocess.call(["sofia", f"{updated_parfile}"])
-            eliminate_time(output_catalog)
-        else:
-            print('sofia not available. Please install Sofia-2')
-            sys.exit(1)
-    else:
-        print(f"We have already found the catalogue {output_catalog}. \
-                Sofia will not be executed" )
+    print(f'Parfile: {parfile}')
+    updated_parfile = update_parfile(parfile, output_path, datacube,
+          scfind_threshold, reliability_fmin,
+          reliability_threshold, region=region,
+          datacube_name=datacube_name, threads=threads,
+          parameters=noise_parameters(noise))
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        key = sofia_cache.cache_key(updated_parfile, datacube,
+                                    sofia_cache.sofia_version(),
+                                    os.path.join(cache_dir, sofia_cache.DIGESTS))
+        if sofia_cache.restore(cache_dir, key, output_path, datacube_name):
+            return
+    execute_sofia(updated_parfile, output_catalog)
+    if cache_dir is not None:
+        sofia_cache.store(cache_dir, key, output_path, datacube_name,
+                          float(cache_size)*2**30)
+
+def execute_sofia(updated_parfile, output_catalog):
+    '''Executes Sofia with a parameters file and removes the timestamp from
+    the output catalog
+
+    Parameters
+    ----------
+    updated_parfile: str
+        File with the parameters of the execution
+    output_catalog: str
+        Path to the catalog written by Sofia
+    '''
+    if not is_tool('sofia'):
+        print('sofia not available. Please install Sofia-2')
+        sys.exit(1)
+    print('Executing Sofia-2')
+    subprocess.call(["sofia", f"{updated_parfile}"])
+    eliminate_time(output_catalog)
+
+def noise_parameters(noise):
+    '''Returns the Sofia parameters that read the noise from a noise cube
+    instead of measuring it
+
+    Parameters
+    ----------
+    noise: str
+        Noise cube, or None to measure the noise with Sofia
+    Returns
+    -------
+    parameters: dict
+        Sofia parameters
+    '''
+    if noise is None:
+        return {}
+    return {'input.noise': noise, 'scaleNoise.enable': 'false'}
+
+def sweep_point_name(scfind_threshold, reliability_fmin,
+                     reliability_threshold):
+    '''Returns the name of the directory of one point of a parameter sweep
+
+    Parameters
+    ----------
+    scfind_threshold: str
+        Sofia parameter scfind_threshold
+    reliability_fmin: str
+        Sofia parameter reliability_fmin
+    reliability_threshold: str
+        Sofia parameter reliability_threshold
+    Returns
+    -------
+    name: str
+        Name of the directory
+    '''
+    return f's{scfind_threshold}_f{reliability_fmin}_r{reliability_threshold}'
+
+def sweep_sofia(parfile, outname, datacube, results_path,
+                scfind_thresholds, reliability_fmins, reliability_thresholds,
+                threads=None, noise=None):
+    '''Runs Sofia for every point of a grid of parameters, repeating only
+    the steps that depend on each parameter. The noise is measured once, in
+    the first run, and read from its noise cube by the others, unless
+    `noise` is given. Source finding
+    runs once per `scfind_threshold`, and its raw mask is read by the runs
+    of the other reliability parameters, which only link the detections and
+    measure their reliability
+
+    Parameters
+    ----------
+    parfile: str
+        File contanining parameters
+    outname: str
+        Name of output directory
+    datacube: str
+        Path to data cube
+    results_path: str
+        Path to save results
+    scfind_thresholds: list of str
+        Values of the Sofia parameter scfind_threshold
+    reliability_fmins: list of str
+        Values of the Sofia parameter reliability_fmin
+    reliability_thresholds: list of str
+        Values of the Sofia parameter reliability_threshold
+    threads: int
+        Number of threads used by Sofia. Default is the value in `parfile`
+    noise: str
+        Noise cube read by every run instead of measuring the noise
+    Returns
+    -------
+    sweep_table: str
+        File listing the catalog of each point of the grid
+    '''
+    sweep_path = os.path.join(results_path, outname, 'sweep')
+    os.makedirs(sweep_path, exist_ok=True)
+    datacube_name = os.path.basename(datacube).replace('.fits','')
+    noise_cube = noise
+    rows = ['scfind_threshold,reliability_fmin,reliability_threshold,catalog']
+    for scfind_threshold in scfind_thresholds:
+        raw_mask = None
+        for reliability_fmin, reliability_threshold in product(
+                reliability_fmins, reliability_thresholds):
+            output_path = os.path.join(sweep_path, sweep_point_name(
+                scfind_threshold, reliability_fmin, reliability_threshold))
+            os.makedirs(output_path, exist_ok=True)
+            # Catalogs only, without the products of each source
+            parameters = {'output.writeCubelets': 'false',
+                          'output.writeMoments': 'false'}
+            if noise_cube is None:
+                parameters['output.writeNoise'] = 'true'
+            else:
+                parameters['input.noise'] = noise_cube
+                parameters['scaleNoise.enable'] = 'false'
+            if raw_mask is None:
+                parameters['output.writeRawMask'] = 'true'
+            else:
+                parameters['input.mask'] = raw_mask
+                parameters['scfind.enable'] = 'false'
+            updated_parfile = update_parfile(parfile, output_path, datacube,
+                  scfind_threshold, reliability_fmin, reliability_threshold,
+                  datacube_name=datacube_name, threads=threads,
+                  parameters=parameters)
+            output_catalog = os.path.join(output_path,
+                                          f'{datacube_name}_cat.txt')
+            execute_sofia(updated_parfile, output_catalog)
+            if noise_cube is None:
+                noise_cube = os.path.join(output_path,
+                                          f'{datacube_name}_noise.fits')
+            if raw_mask is None:
+                raw_mask = os.path.join(output_path,
+                                        f'{datacube_name}_mask-raw.fits')
+            rows.append(f'{scfind_threshold},{reliability_fmin},'
+                        f'{reliability_threshold},{output_catalog}')
+    sweep_table = os.path.join(sweep_path, 'sweep_catalogs.csv')
+    with open(sweep_table, 'w') as fileout:
+        fileout.write('\n'.join(rows) + '\n')
+    return sweep_table
 
 def main():
-    ''' Runs Sofia if the output catalog does not exist'''
+    ''' Runs Sofia, or restores its products from the cache'''
     args = get_args()
     if not os.path.isdir(args.results_path):
         os.mkdir(args.results_path)
+    if args.sweep:
+        if args.coord_file is not None:
+            raise ValueError('The sweep mode needs the fits file of the '
+                             'subcube, not a region of the data cube')
+        sweep_sofia(parfile=args.parfile, outname=args.outname,
+                    datacube=args.datacube, results_path=args.results_path,
+                    scfind_thresholds=str(args.scfind_threshold).split(','),
+                    reliability_fmins=str(args.reliability_fmin).split(','),
+                    reliability_thresholds=str(
+                        args.reliability_threshold).split(','),
+                    threads=args.threads, noise=args.noise)
+        return
     run_sofia(parfile=args.parfile, outname=args.outname,
               datacube=args.datacube, results_path=args.results_path,
               scfind_threshold=args.scfind_threshold,
               reliability_fmin=args.reliability_fmin,
-              reliability_threshold=args.reliability_threshold)
+              reliability_threshold=args.reliability_threshold,
+              coord_file=args.coord_file, idx=args.idx, threads=args.threads,
+              noise=args.noise, cache_dir=args.cache_dir, cache_size=args.cache_size)
 
 if __name__ == '__main__':
     main()
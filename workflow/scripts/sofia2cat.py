@@ -20,16 +20,25 @@ This script converts sofia Catalog to the SDC2 catalog
 
 
 import os
+import io
 import argparse
-import re
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
 import pandas as pd
 import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy import constants as const
+from split_subcube import read_coord_file, header_file
+from catalog_io import CATALOG_FORMATS, write_catalog
 
 cspeed = const.c.value      # m/s
 F0_H1 = 1420405751.786    # Hz
+# Types of the columns of VOTable catalogs
+VOTABLE_TYPES = {'char': str, 'unicodeChar': str, 'boolean': bool,
+                 'unsignedByte': int, 'short': int, 'int': int, 'long': int,
+                 'float': float, 'double': float}
 
 def get_args():
     '''This function parses and returns arguments passed in'''
@@ -37,19 +46,59 @@ def get_args():
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-r', '--results_path', dest='results_path', \
                         help='Directory for results', default='results')
-    parser.add_argument('-o', '--outname', dest='outname', help='Name of \
-                        output directory for Sofia products', default='test')
+    parser.add_argument('-o', '--outname', dest='outname', nargs='+', \
+                        help='Name of output directory for Sofia products. \
+                        Several names convert several catalogs in one \
+                        process', default=['test'])
     parser.add_argument('-d', '--datacube', dest='datacube', help='Data cube \
                         to process. Options are: development, development_large,\
                         evaluation', default='development')
-    parser.add_argument('-i', '--incatalog', dest='incatalog', help='Path of \
-                        the input Sofia catalog to be converted', \
-                        default='development')
+    parser.add_argument('-i', '--incatalog', dest='incatalog', nargs='+', \
+                        help='Path of the input Sofia catalog to be \
+                        converted, one per output name', \
+                        default=['development'])
+    parser.add_argument('-c', '--coord', dest='coord_file', help='File with \
+                        edge coordinates of subcubes. If given, sources \
+                        truncated by the edges of frequency slabs are \
+                        removed', default=None)
+    parser.add_argument('-f', '--format', dest='format', help='Format of the \
+                        output catalog', choices=CATALOG_FORMATS, \
+                        default='csv')
+    parser.add_argument('--header', dest='header', nargs='+', help='Header \
+                        of the processed data cube, either a fits file or \
+                        its sidecar text file, one per output name. Default \
+                        is the header sidecar of the fits file in the \
+                        parameters file, or the fits file itself', \
+                        default=None)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number \
+                        of processes converting catalogs in parallel', \
+                        default=1)
     args = parser.parse_args()
     return args
 
-def read_sofia_header(filename):
-    '''Reads SOFIA header
+def read_sofia_header(lines):
+    '''Reads the names of the columns from the header of a SOFIA catalog in
+    ASCII format. They are in the first comment line starting with `name`
+
+    Parameters
+    ----------
+    lines: list of str
+        Lines of the catalog
+    Returns
+    -------
+    head: list of str
+        Names of the columns
+    '''
+    for line in lines:
+        if not line.startswith('#'):
+            break
+        head = line.lstrip('#').split()
+        if head and head[0] == 'name':
+            return head
+    raise ValueError('Header with the names of the columns not found')
+
+def read_sofia_ascii(filename):
+    '''Reads a SOFIA catalog in ASCII format, reading the file only once
 
     Parameters
     ----------
@@ -57,13 +106,68 @@ def read_sofia_header(filename):
         Input file name
     Returns
     -------
-    head: str
-        Header of input file
+    raw_cat: pandas DataFrame
+        Raw catalog produced by sofia
     '''
     with open(filename, 'r') as infile:
-        head_line = infile.readlines()[10]
-    head = re.split('\s+', head_line.strip('\n'))[1:] # 1: to remove #
-    return head
+        text = infile.read()
+    head = read_sofia_header(text.splitlines())
+    raw_cat = pd.read_csv(io.StringIO(text), delim_whitespace=True,
+                          header=None, names=head, comment='#')
+    # The names of the sources contain a space, so their first word is read
+    # as the index
+    if not isinstance(raw_cat.index, pd.RangeIndex):
+        raw_cat['name'] = raw_cat.index + ' ' + raw_cat['name']
+        raw_cat.reset_index(drop=True, inplace=True)
+    return raw_cat
+
+def read_sofia_xml(filename):
+    '''Reads a SOFIA catalog in XML (VOTable) format with a streaming
+    parser, converting each column to the type declared in its FIELD
+
+    Parameters
+    ----------
+    filename: str
+        Input file name
+    Returns
+    -------
+    raw_cat: pandas DataFrame
+        Raw catalog produced by sofia
+    '''
+    names = []
+    dtypes = []
+    rows = []
+    for _, elem in ElementTree.iterparse(filename, events=('end',)):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'FIELD':
+            names.append(elem.get('name'))
+            dtypes.append(VOTABLE_TYPES.get(elem.get('datatype'), str))
+        elif tag == 'TR':
+            rows.append([(cell.text or '').strip() for cell in elem])
+            elem.clear()
+    columns = zip(*rows) if rows else [()]*len(names)
+    return pd.DataFrame({name: np.array(column, dtype=str).astype(dtype)
+                         for name, dtype, column in zip(names, dtypes,
+                                                        columns)})
+
+def read_sofia_catalog(catalog):
+    '''Reads a SOFIA catalog. The XML catalog written next to the ASCII
+    catalog is used when available, and the ASCII catalog otherwise
+
+    Parameters
+    ----------
+    catalog: str
+        Input file name of the ASCII catalog
+    Returns
+    -------
+    raw_cat: pandas DataFrame
+        Raw catalog produced by sofia
+    '''
+    xml_catalog = os.path.splitext(catalog)[0] + '.xml'
+    if os.path.isfile(xml_catalog):
+        print(f'Reading XML catalog {xml_catalog}')
+        return read_sofia_xml(xml_catalog)
+    return read_sofia_ascii(catalog)
 
 def sofia2cat(catalog):
     '''Runs sofia and returns the raw catalog filtered with galaxies that have
@@ -79,35 +183,117 @@ def sofia2cat(catalog):
         Raw catalog produced by sofia filtered by kinematic position angle
         greater than zero.
     '''
-    head = read_sofia_header(catalog)
-    raw_cat = pd.read_csv(catalog, delim_whitespace=True, header=None, \
-                          names=head, comment='#')
+    raw_cat = read_sofia_catalog(catalog)
     raw_cat.sort_values(by='f_sum', ascending=False, inplace=True)
     raw_cat_filtered = raw_cat[raw_cat['kin_pa']>0]
     print('Producing sofia raw catalog filtered by kin_pa > 0:')
     return raw_cat_filtered
 
+def remove_truncated_sources(raw_cat, coord_subcubes, idx, offset=False):
+    '''Removes the sources touching an edge of the frequency slab of subcube
+    `idx` that is not an edge of the master cube. With enough channel overlap
+    between slabs these sources are fully detected in the neighbouring slab
+
+    Parameters
+    ----------
+    raw_cat: pandas DataFrame
+        Raw catalog
+    coord_subcubes: array
+        Array containing coordinates of subcubes
+    idx: int
+        Index of subcube
+    offset: bool
+        True if the pixel coordinates of the catalog refer to the master cube
+    Returns
+    -------
+    raw_cat: pandas DataFrame
+        Raw catalog without the truncated sources
+    '''
+    z_0 = int(coord_subcubes[idx]['z0'])
+    z_1 = int(coord_subcubes[idx]['z1'])
+    n_chan = int(np.max(coord_subcubes['z1']))
+    shift = 0 if offset else z_0
+    truncated = ((raw_cat['z_min'] + shift <= z_0) & (z_0 > 0)) | \
+                ((raw_cat['z_max'] + shift >= z_1 - 1) & (z_1 < n_chan))
+    print(f'Removing {truncated.sum()} sources truncated by the slab edges')
+    return raw_cat[~truncated]
+
+@lru_cache(maxsize=None)
+def read_header(filename):
+    '''Reads the header of a data cube once per process. Text files written
+    by `split_subcube` are read without opening the fits file, and for fits
+    files only the header is read
+
+    Parameters
+    ----------
+    filename: str
+        Fits file or sidecar text file with its header
+    Returns
+    -------
+    hdr: astropy.io.fits.Header
+        Header of the data cube
+    '''
+    if os.path.splitext(filename)[1] == '.hdr':
+        return fits.Header.fromtextfile(filename)
+    return fits.getheader(filename)
+
+@lru_cache(maxsize=None)
+def read_wcs(filename):
+    '''Builds the WCS of a data cube once per process
+
+    Parameters
+    ----------
+    filename: str
+        Fits file or sidecar text file with its header
+    Returns
+    -------
+    wcs: class astropy.wcs
+        wcs of the data cube
+    '''
+    return WCS(read_header(filename))
+
+def find_header(fitsfile):
+    '''Returns the sidecar file with the header of a fits file if it exists,
+    and the fits file otherwise
+
+    Parameters
+    ----------
+    fitsfile: str
+        Path to fits file
+    Returns
+    -------
+    filename: str
+        File from which the header is read
+    '''
+    if os.path.isfile(header_file(fitsfile)):
+        return header_file(fitsfile)
+    return fitsfile
+
 def pix2coord(wcs, pix_x, pix_y):
     '''
-    Converts pixels to coordinates using WCS header info
+    Converts pixels to coordinates using WCS header info. The pixels of all
+    the sources are converted at once to arrays of world coordinates, without
+    building sky coordinate objects
 
     Parameters
     ----------
     wcs: class astropy.wcs
         wcs of the fits file
-    pix_x: int
+    pix_x: array of floats
         Pixel number in X direction
-    pix_y: int
+    pix_y: array of floats
         Pixel number in Y direction
     Returns
     -------
-    coord[0].ra.deg: float
+    ra_deg: array of floats
         Right ascension in degrees
-    coord[0].dec.deg: float
+    dec_deg: array of floats
         Declination in degrees
     '''
-    coord = wcs.pixel_to_world(pix_x, pix_y, 1)
-    return coord[0].ra.deg, coord[0].dec.deg
+    pix_x = np.asarray(pix_x, dtype=float)
+    pix_y = np.asarray(pix_y, dtype=float)
+    world = wcs.all_pix2world(pix_x, pix_y, np.ones_like(pix_x), 0)
+    return world[wcs.wcs.lng], world[wcs.wcs.lat]
 
 def compute_inclination(bmaj, bmin):
     '''Computes inclinaton
@@ -141,7 +327,7 @@ def convert_units(raw_cat, fitsfile):
     raw_cat: pandas DataFrame
         Raw catalog
     fitsfile: string
-        Path to fits file
+        Path to fits file, or to the sidecar file with its header
     Returns
     -------
     ra_deg: array of floats
@@ -154,15 +340,13 @@ def convert_units(raw_cat, fitsfile):
         Conversion factor from channel to Hz
     '''
 
-    file = fits.open(fitsfile)
-    wcs=WCS(file[0].header)
-    file.close()
+    wcs = read_wcs(fitsfile)
     # Convert x,y in pixels to R.A.,Dec. in deg
     ra_deg, dec_deg = pix2coord(wcs, raw_cat['x'], raw_cat['y'])
     # Get pixel size
     pix2arcsec = wcs.wcs.get_cdelt()[1]*3600. # This assumes same pixel size
                                               #in both direction
-    pix2freq = file[0].header['CDELT3']
+    pix2freq = read_header(fitsfile)['CDELT3']
     return ra_deg, dec_deg, pix2arcsec,pix2freq
 
 def frequency_to_vel(freq, invert=False):
@@ -201,13 +385,13 @@ def convert_flux(flux,filename):
     flux: array of floats
         Flux in Jy/beam
     filename: str
-        Name of input file
+        Name of input file, or of the sidecar file with its header
     Returns
     -------
     flux_jy_hz: array of floats
         flux in Jy*Hz
     '''
-    hdr = fits.getheader(filename)
+    hdr = read_header(filename)
     print(hdr['BMAJ'],hdr['BMIN'])
     beamarea=(np.pi*abs(hdr['BMAJ']*hdr['BMIN']))/(4.*np.log(2.))
     pix_per_beam = beamarea/(abs(hdr['CDELT1'])*abs(hdr['CDELT2']))
@@ -271,7 +455,7 @@ def convert_frequency_axis(filename, outname, velocity_req = 'radio'):
         del hdr['CUNIT3']
     fits.writeto(outname,cube[0].data,hdr,overwrite = True)
 
-def process_catalog(raw_cat, fitsfile):
+def process_catalog(raw_cat, fitsfile, subcube=None):
     '''Process catalog
 
     Parameters
@@ -279,7 +463,11 @@ def process_catalog(raw_cat, fitsfile):
     raw_cat: pandas.DataFrame
         Raw catalog
     fitsfile: str
-        Path to fits file of processed data cube
+        Path to fits file of processed data cube, or to the sidecar file with
+        its header
+    subcube: str
+        Index of the subcube. Default is to take it from the name of the fits
+        file
     Returns
     -------
     processed_cat: pandas.DataFrame
@@ -287,58 +475,89 @@ def process_catalog(raw_cat, fitsfile):
     '''
     # Unit conversion
     ra_deg, dec_deg, pix2arcsec,pix2freq = convert_units(raw_cat, fitsfile)
-    hi_size = raw_cat['ell_maj']*pix2arcsec
+    # The conversions below operate on plain arrays, in the order of raw_cat
+    column = {name: raw_cat[name].to_numpy() for name in raw_cat.columns}
+    hi_size = column['ell_maj']*pix2arcsec
     # Estimate inclination based on fitted ellipsoid, assuming the galaxy is
     # intrinsically circular
-    inclination = compute_inclination(raw_cat['ell_maj'], raw_cat['ell_min'])
-
-    # Construct the output catalog
-    processed_cat = pd.DataFrame()
-    processed_cat['id_subcube'] = raw_cat['id']
-    processed_cat['ra'] = ra_deg
-    processed_cat['dec'] = dec_deg
-    processed_cat['hi_size'] = hi_size
+    inclination = compute_inclination(column['ell_maj'], column['ell_min'])
     # Now converted to Jy*km/s verifcation for developments needed
-    processed_cat['line_flux_integral'] = convert_flux(raw_cat['f_sum'],\
-                                                       fitsfile)
-    if 'freq' in raw_cat:
-        processed_cat['central_freq'] =  raw_cat['freq']
-        processed_cat['w20'] = frequency_to_vel(raw_cat['freq']-\
-                               raw_cat['w20']/2.*pix2freq)-\
-                               frequency_to_vel(raw_cat['freq']+\
-                               raw_cat['w20']/2.*pix2freq) # we need to clarify
-                                   # if the units and the definition is the same
+    line_flux_integral = convert_flux(column['f_sum'], fitsfile)
+    if 'freq' in column:
+        central_freq = column['freq']
+        # we need to clarify if the units and the definition is the same
+        w20 = frequency_to_vel(column['freq']-column['w20']/2.*pix2freq)-\
+              frequency_to_vel(column['freq']+column['w20']/2.*pix2freq)
     else:
-        #processed_cat['central_velocity'] =  raw_cat['v_app']
-        if 'v_app' in raw_cat.columns:
+        if 'v_app' in column:
             print('Using v_app column')
-            processed_cat['central_freq'] = frequency_to_vel(raw_cat['v_app'],\
-                                                             invert=True)
-        elif 'freq' in raw_cat.columns:
-            print('Using freq column')
-            processed_cat['central_freq'] = raw_cat['freq']
+            central_freq = frequency_to_vel(column['v_app'], invert=True)
         # This case should not be included for production,
         # just to test the minimal cube
-        elif 'v_opt' in raw_cat.columns:
+        elif 'v_opt' in column:
             print('WARNING. Using v_opt column. Use only to check the workflow')
-            processed_cat['central_freq'] = frequency_to_vel(raw_cat['v_opt'],\
-                                                             invert=True)
-        processed_cat['w20'] = raw_cat['w20']*pix2freq
+            central_freq = frequency_to_vel(column['v_opt'], invert=True)
+        w20 = column['w20']*pix2freq
          # we need to clarify if what sofia gives is the central freq
-    processed_cat['w20'] *= 1e-3 # To convert from m/s to km/s
-    # we need to clarify if Sofia kinematic angle agrees with their P.A.
-    processed_cat['pa'] = raw_cat['kin_pa']
-    processed_cat['i'] = inclination
-    processed_cat['rms'] = raw_cat['rms']
-    processed_cat['subcube'] = os.path.basename(fitsfile).split('_')[1].split('.fits')[0]
-    processed_cat.reset_index(drop=True, inplace=True)
-    # This is just to set the right order of the output columns
-    processed_cat = processed_cat[['id_subcube', 'ra', 'dec', 'hi_size', \
-                                   'line_flux_integral', 'central_freq', 'pa', \
-                                   'i', 'w20', 'rms', 'subcube']]
-    processed_cat['central_freq'] = processed_cat['central_freq'].map('{:.1f}'.format)
+    w20 = w20*1e-3 # To convert from m/s to km/s
+    if subcube is None:
+        subcube = os.path.splitext(os.path.basename(fitsfile))[0].split('_')[1]
+
+    # Construct the output catalog, with the right order of the columns
+    processed_cat = pd.DataFrame({
+        'id_subcube': column['id'],
+        'ra': ra_deg,
+        'dec': dec_deg,
+        'hi_size': hi_size,
+        'line_flux_integral': line_flux_integral,
+        'central_freq': np.round(central_freq, 1),
+        # we need to clarify if Sofia kinematic angle agrees with their P.A.
+        'pa': column['kin_pa'],
+        'i': inclination,
+        'w20': w20,
+        'rms': column['rms'],
+        'subcube': subcube})
     return processed_cat
 
+@lru_cache(maxsize=None)
+def read_parameters(parfile):
+    """ Reads all the parameters of the parfile once per process
+
+    Parameters
+    ----------
+    parfile: str
+        Parameters file
+    Returns
+    -------
+    parameters: dict
+        Values of the parameters, without comments. The first value is kept
+        for repeated parameters
+    """
+    parameters = {}
+    with open(parfile, 'r') as infile:
+        for line in infile:
+            if '=' in line:
+                name, value = line.split('=', 1)
+                parameters.setdefault(name.strip(),
+                                      value.split('=')[0].split('#')[0].strip())
+    return parameters
+
+def find_parameter(parfile, parameter):
+    """ Searchs in the parfile the value of a parameter
+
+    Parameters
+    ----------
+    parfile: str
+        Parameters file
+    parameter: str
+        Name of the parameter
+    Returns
+    -------
+    value: str
+        Value of the parameter, without comments
+    """
+    return read_parameters(parfile).get(parameter)
+
 def find_fitsfile(parfile):
     """ Searchs in the parfile the name of the fits file used
 
@@ -351,24 +570,96 @@ def find_fitsfile(parfile):
     fitsfile: str
         Path to fits file of processed data cube
     """
-    with open(parfile, 'r') as infile:
-        for line in infile.readlines():
-            if 'input.data' in line:
-                break
-        fitsfile = line.split('=')[1].strip()
-    return fitsfile
+    return find_parameter(parfile, 'input.data')
+
+
+def convert_catalog(incatalog, outname, header=None, results_path='results',
+                    fmt='csv', coord_subcubes=None):
+    '''Converts the Sofia catalog of one subcube to the SDC2 catalog
+
+    Parameters
+    ----------
+    incatalog: str
+        Path of the input Sofia catalog
+    outname: str
+        Name of output directory for Sofia products, the index of the subcube
+    header: str
+        Fits file or sidecar text file with the header of the processed data
+        cube. Default is to find it from the parameters file
+    results_path: str
+        Directory for results
+    fmt: str
+        Format of the output catalog
+    coord_subcubes: structured array
+        Grid of subcubes. If given, sources truncated by the edges of
+        frequency slabs are removed
+    Returns
+    -------
+    final_cat_file: str
+        Path of the output catalog
+    '''
+    output_path = os.path.join(results_path, outname)
+    raw_cat = sofia2cat(catalog=incatalog)
+    parfile = os.path.join(output_path, 'sofia.par')
+    fitsfile = header or find_header(find_fitsfile(parfile))
+    if coord_subcubes is not None:
+        offset = find_parameter(parfile, 'parameter.offset') == 'true'
+        raw_cat = remove_truncated_sources(raw_cat, coord_subcubes,
+                                           int(outname), offset=offset)
+    # The fits file is the master cube when Sofia processed a region of it
+    processed_cat = process_catalog(raw_cat, fitsfile, subcube=outname)
+    final_cat_file = incatalog.replace('_cat.txt', f'_final_catalog.{fmt}')
+    if fmt == 'csv':
+        # Frequencies are written to the text catalog with one decimal
+        processed_cat['central_freq'] = processed_cat['central_freq'].map(
+            '{:.1f}'.format)
+    else:
+        processed_cat = processed_cat.astype({'subcube': int})
+    write_catalog(processed_cat, final_cat_file)
+    return final_cat_file
 
+def convert_catalogs(incatalogs, outnames, headers=None, jobs=1, **kwargs):
+    '''Converts the Sofia catalogs of several subcubes in one process, so
+    that the modules are imported once and the headers are read once. With
+    `jobs` > 1 the catalogs are converted by a pool of processes
+
+    Parameters
+    ----------
+    incatalogs: list of str
+        Paths of the input Sofia catalogs
+    outnames: list of str
+        Names of output directories for Sofia products, one per catalog
+    headers: list of str
+        Files with the headers of the processed data cubes, one per catalog
+    jobs: int
+        Number of processes converting catalogs in parallel
+    **kwargs:
+        Other arguments of `convert_catalog`
+    Returns
+    -------
+    final_cat_files: list of str
+        Paths of the output catalogs
+    '''
+    if len(incatalogs) != len(outnames):
+        raise ValueError(f'{len(incatalogs)} catalogs given for '
+                         f'{len(outnames)} output names')
+    if headers is None:
+        headers = [None]*len(incatalogs)
+    convert = partial(convert_catalog, **kwargs)
+    if jobs > 1 and len(incatalogs) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(convert, incatalogs, outnames, headers))
+    return list(map(convert, incatalogs, outnames, headers))
 
 def main():
     ''' Converts sofia Catalog to the SDC2 catalog'''
     args = get_args()
-    output_path = os.path.join(args.results_path, args.outname)
-    incatalog = args.incatalog
-    raw_cat = sofia2cat(catalog=incatalog)
-    fitsfile = find_fitsfile(os.path.join(output_path, 'sofia.par'))
-    processed_cat = process_catalog(raw_cat, fitsfile)
-    final_cat_file = incatalog.replace('_cat.txt', '_final_catalog.csv')
-    processed_cat.to_csv(final_cat_file, sep=' ', index=False)
+    coord_subcubes = None
+    if args.coord_file is not None:
+        coord_subcubes = read_coord_file(args.coord_file)
+    convert_catalogs(args.incatalog, args.outname, headers=args.header,
+                     jobs=args.jobs, results_path=args.results_path,
+                     fmt=args.format, coord_subcubes=coord_subcubes)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,304 @@
+# This file is part of Hi-FRIENDS SDC2
+# (https://github.com/HI-FRIENDS-SDC2/hi-friends).
+# Copyright (c) 2021 Javier Moldón
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+This module stores the products of Sofia in a local cache, indexed by the
+parameters of the execution, the version of Sofia and the contents of the
+data cube, so that identical executions are not repeated
+'''
+
+import os
+import re
+import json
+import uuid
+import shutil
+import hashlib
+import subprocess
+
+# Parameters that do not change the results of Sofia. The data cube is
+# identified by its contents instead of by its path
+IGNORED_PARAMETERS = ['input.data', 'output.directory', 'output.filename',
+                      'pipeline.threads', 'pipeline.verbose']
+# Parameters naming input files, which are identified by their contents
+FILE_PARAMETERS = ['input.noise', 'input.mask', 'input.gain',
+                   'input.weights']
+# Products of the workflow derived from the catalog of Sofia, which are not
+# part of the execution of Sofia
+DERIVED_PRODUCTS = ('_final_catalog', '_dedup_catalog')
+MANIFEST = 'manifest.json'
+# Subdirectory of the cache with the digests of the input files
+DIGESTS = 'digests'
+
+def sofia_version():
+    '''Returns the version of Sofia, as printed by Sofia without arguments
+
+    Returns
+    -------
+    version: str
+        Version of Sofia, or `unknown` if it is not found
+    '''
+    try:
+        output = subprocess.run(['sofia'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, check=False,
+                                universal_newlines=True).stdout
+    except OSError:
+        return 'unknown'
+    match = re.search(r'SoFiA\s+v?(\d+(\.\d+)+)', output)
+    return match.group(1) if match else 'unknown'
+
+def file_digest(filename, digest_dir=None, block_size=2**20):
+    '''Computes the digest of the full contents of a file. With `digest_dir`
+    the digest is stored there in a sidecar file, together with the path,
+    size, modification time and inode of the file, and it is only computed
+    again when any of them changes
+
+    Parameters
+    ----------
+    filename: str
+        File name
+    digest_dir: str
+        Directory of the sidecar files with the digests, or None
+    block_size: int
+        Number of bytes read at a time
+    Returns
+    -------
+    digest: str
+        Hexadecimal digest of the file
+    '''
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    identity = {'path': path, 'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+    sidecar = None
+    if digest_dir is not None:
+        name = hashlib.sha256(path.encode()).hexdigest()
+        sidecar = os.path.join(digest_dir, f'{name}.json')
+        try:
+            with open(sidecar, 'r') as infile:
+                stored = json.load(infile)
+            if stored['file'] == identity:
+                return stored['digest']
+        except (OSError, ValueError, KeyError):
+            pass
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+    if sidecar is not None:
+        # Written to a temporary file and renamed, so that concurrent jobs
+        # never read an incomplete sidecar
+        os.makedirs(digest_dir, exist_ok=True)
+        tmp_sidecar = f'{sidecar}.{uuid.uuid4().hex}'
+        with open(tmp_sidecar, 'w') as outfile:
+            json.dump({'file': identity, 'digest': digest}, outfile)
+        os.replace(tmp_sidecar, sidecar)
+    return digest
+
+def cache_key(parfile, datacube, version, digest_dir=None):
+    '''Computes the key of an execution of Sofia in the cache. The data cube
+    and the other input files named in the parameters are identified by the
+    digest of their contents
+
+    Parameters
+    ----------
+    parfile: str
+        Parameters file of the execution
+    datacube: str
+        Data cube processed
+    version: str
+        Version of Sofia
+    digest_dir: str
+        Directory of the sidecar files with the digests of the input files,
+        or None
+    Returns
+    -------
+    key: str
+        Hexadecimal key of the execution
+    '''
+    key = hashlib.sha256(f'SoFiA {version}\n'.encode())
+    with open(parfile, 'r') as infile:
+        for line in infile:
+            name = line.split('=')[0].strip()
+            if name in IGNORED_PARAMETERS:
+                continue
+            value = line.split('=', 1)[-1].split('#')[0].strip()
+            if name in FILE_PARAMETERS and value:
+                line = f'{name} = {file_digest(value, digest_dir)}\n'
+            key.update(line.encode())
+    key.update(file_digest(datacube, digest_dir).encode())
+    return key.hexdigest()
+
+def directory_size(path):
+    '''Returns the total size of the files in a directory
+
+    Parameters
+    ----------
+    path: str
+        Directory
+    Returns
+    -------
+    size: int
+        Size in bytes
+    '''
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+def sofia_products(path, name):
+    '''Returns the products written by Sofia in a directory: the files whose
+    names start with `name` and the directory of cubelets. The catalogs
+    derived from them by the workflow and the subdirectories of other
+    executions, such as the sweep, are not included
+
+    Parameters
+    ----------
+    path: str
+        Output directory of Sofia
+    name: str
+        Name of the products of Sofia
+    Returns
+    -------
+    products: list of str
+        Names of the files and directories in `path`
+    '''
+    products = []
+    for entry in sorted(os.listdir(path)):
+        if not entry.startswith(name) or entry[len(name):][:1] not in '_.':
+            continue
+        if entry[len(name):].startswith(DERIVED_PRODUCTS):
+            continue
+        if os.path.isfile(os.path.join(path, entry)) or \
+                entry == f'{name}_cubelets':
+            products.append(entry)
+    return products
+
+def copy_products(source, destination, old_name, new_name):
+    '''Copies the products of Sofia between directories, renaming the files
+    and directories whose names start with the name of the products
+
+    Parameters
+    ----------
+    source: str
+        Source directory
+    destination: str
+        Destination directory
+    old_name: str
+        Name of the products in `source`
+    new_name: str
+        Name of the products in `destination`
+    '''
+    def rename(name):
+        return new_name + name[len(old_name):] if name.startswith(old_name) \
+               else name
+    os.makedirs(destination, exist_ok=True)
+    for product in sofia_products(source, old_name):
+        source_path = os.path.join(source, product)
+        target_path = os.path.join(destination, rename(product))
+        if os.path.isfile(source_path):
+            shutil.copy2(source_path, target_path)
+            continue
+        os.makedirs(target_path, exist_ok=True)
+        for name in os.listdir(source_path):
+            shutil.copy2(os.path.join(source_path, name),
+                         os.path.join(target_path, rename(name)))
+
+def restore(cache_dir, key, output_path, datacube_name):
+    '''Copies the products of an execution from the cache, if it is there,
+    and marks it as recently used
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache
+    key: str
+        Key of the execution
+    output_path: str
+        Output directory of Sofia
+    datacube_name: str
+        Name of the products of Sofia
+    Returns
+    -------
+    found: bool
+        True if the execution was found in the cache
+    '''
+    entry = os.path.join(cache_dir, key)
+    manifest = os.path.join(entry, MANIFEST)
+    if not os.path.isfile(manifest):
+        return False
+    with open(manifest, 'r') as infile:
+        cached_name = json.load(infile)['datacube_name']
+    copy_products(entry, output_path, cached_name, datacube_name)
+    os.utime(manifest)
+    print(f'Sofia products restored from the cache entry {entry}')
+    return True
+
+def store(cache_dir, key, output_path, datacube_name, max_size):
+    '''Stores the products of an execution in the cache, and evicts the
+    least recently used entries until the cache fits in `max_size`
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache
+    key: str
+        Key of the execution
+    output_path: str
+        Output directory of Sofia
+    datacube_name: str
+        Name of the products of Sofia
+    max_size: float
+        Maximum size of the cache in bytes
+    '''
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    # Entries are written to a temporary directory and renamed, so that
+    # concurrent jobs never read an incomplete entry
+    tmp_entry = os.path.join(cache_dir, f'.tmp_{uuid.uuid4().hex}')
+    copy_products(output_path, tmp_entry, datacube_name, datacube_name)
+    with open(os.path.join(tmp_entry, MANIFEST), 'w') as outfile:
+        json.dump({'datacube_name': datacube_name}, outfile)
+    try:
+        os.rename(tmp_entry, entry)
+        print(f'Sofia products stored in the cache entry {entry}')
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict(cache_dir, max_size)
+
+def evict(cache_dir, max_size):
+    '''Removes the least recently used entries of the cache until its size
+    is below `max_size`
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache
+    max_size: float
+        Maximum size of the cache in bytes
+    '''
+    entries = []
+    for key in os.listdir(cache_dir):
+        manifest = os.path.join(cache_dir, key, MANIFEST)
+        if os.path.isfile(manifest):
+            entries.append((os.path.getmtime(manifest), key,
+                            directory_size(os.path.join(cache_dir, key))))
+    total = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total <= max_size:
+            break
+        print(f'Evicting cache entry {key}')
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
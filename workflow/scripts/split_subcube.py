@@ -18,27 +18,134 @@
 This script splits the cube in different subcubes according to a grid of subcubes
 '''
 
+import os
 import argparse
 import numpy as np
-from spectral_cube import SpectralCube
-from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from global_noise import read_channel_noise, write_noise_cube
+
+PIXEL_KEYS = ['x0', 'x1', 'y0', 'y1', 'z0', 'z1']
 
 def get_args():
     '''This function parses and returns arguments passed in'''
     # Assign description to the help doc
     description = 'Split subcube identified by an index'
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('-i', '--index', dest='idx', help='Subcube index')
+    parser.add_argument('-i', '--index', dest='idx', help='Subcube index. \
+                        In batch mode, comma-separated list of indices or \
+                        "all"')
     parser.add_argument('-d', '--datacube', dest='datacube', \
                         help='Data cube to process.')
     parser.add_argument('-c', '--coord', dest='coord_file', \
                         help='File with edge coordinates of subcubes')
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true', \
+                        help='Write all the selected subcubes in a single \
+                        pass over the data cube', default=False)
+    parser.add_argument('-s', '--slab', dest='slab', type=int, \
+                        help='Number of channels read at once in batch mode', \
+                        default=16)
+    parser.add_argument('-n', '--noise', dest='noise_file', default=None, \
+                        help='File with the noise of each channel of the \
+                        data cube. When given, a noise cube is also written \
+                        for each subcube')
     args = parser.parse_args()
     return args
 
-def split_subcube(infile, coord_subcubes, idx):
-    '''Creates a fits file containing the coordinates
-    x low x high y low and y high
+def read_coord_file(coord_file):
+    '''Reads the file with the definition of the grid of subcubes
+
+    Parameters
+    ----------
+    coord_file: str
+        File with edge coordinates of subcubes
+    Returns
+    -------
+    coord_subcubes: structured array
+        Array with one row per subcube and one field per column of the file
+    '''
+    coord_subcubes = np.genfromtxt(coord_file, delimiter=',', names=True)
+    return np.atleast_1d(coord_subcubes)
+
+def header_file(fitsfile):
+    '''Returns the name of the sidecar file with the header of a fits file
+
+    Parameters
+    ----------
+    fitsfile: str
+        Name of the fits file
+    Returns
+    -------
+    hdr_file: str
+        Name of the text file with the header, next to the fits file
+    '''
+    return os.path.splitext(fitsfile)[0] + '.hdr'
+
+def write_header(header, fitsfile):
+    '''Writes the header of a fits file to its sidecar text file, so that it
+    can be read without opening the fits file
+
+    Parameters
+    ----------
+    header: astropy.io.fits.Header
+        Header of the fits file
+    fitsfile: str
+        Name of the fits file
+    '''
+    header.totextfile(header_file(fitsfile), overwrite=True)
+
+def world_to_pixel_bounds(wcs, cidx, shape):
+    '''Converts the world coordinates of the corners of a subcube into pixel
+    bounds, following the same convention as `SpectralCube.subcube`
+
+    Parameters
+    ----------
+    wcs: class astropy.wcs
+        wcs of the fits file
+    cidx: array
+        Coordinates of the subcube (xlo, ylo, xhi, yhi) in degrees
+    shape: tuple
+        Shape of the data cube (nz, ny, nx)
+    Returns
+    -------
+    bounds: tuple of int
+        Pixel bounds (x0, x1, y0, y1, z0, z1) of the subcube, with the upper
+        bounds excluded
+    '''
+    rows, cols = wcs.celestial.world_to_array_index_values(
+        [cidx['xlo'], cidx['xhi']], [cidx['ylo'], cidx['yhi']])
+    x0, x1 = sorted(cols)
+    y0, y1 = sorted(rows)
+    x0, x1 = max(x0, 0), min(x1+1, shape[2])
+    y0, y1 = max(y0, 0), min(y1+1, shape[1])
+    return int(x0), int(x1), int(y0), int(y1), 0, int(shape[0])
+
+def pixel_bounds(cidx, header, shape):
+    '''Returns the pixel bounds of a subcube. They are read from the grid
+    file when available and derived from the world coordinates otherwise
+
+    Parameters
+    ----------
+    cidx: array
+        Row of the grid file describing the subcube
+    header: astropy.io.fits.Header
+        Header of the data cube
+    shape: tuple
+        Shape of the data cube (nz, ny, nx)
+    Returns
+    -------
+    bounds: tuple of int
+        Pixel bounds (x0, x1, y0, y1, z0, z1) of the subcube, with the upper
+        bounds excluded
+    '''
+    if 'x0' in cidx.dtype.names:
+        return tuple(int(cidx[key]) for key in PIXEL_KEYS)
+    return world_to_pixel_bounds(WCS(header), cidx, shape)
+
+def split_subcube(infile, coord_subcubes, idx, noise=None,
+                  outdir='interim/subcubes'):
+    '''Creates a fits file with the subcube `idx`, copying only its pixels
+    from the memory-mapped data cube
 
     Parameters
     ----------
@@ -48,24 +155,127 @@ def split_subcube(infile, coord_subcubes, idx):
         Array containing coordinates of subcubes
     idx: int
         Index of subcube
+    noise: array
+        Noise of each channel of the data cube. When given, the noise cube of
+        the subcube is also written
+    outdir: str
+        Output directory
+    Returns
+    -------
+    outfile: str
+        Fits file of the subcube
     '''
     print(f'Now exporting item {idx}')
     print(coord_subcubes[idx])
-    cidx = coord_subcubes[idx]
+    with fits.open(infile, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        bounds = pixel_bounds(coord_subcubes[idx], header, data.shape)
+        print(f'Pixel bounds (x0, x1, y0, y1, z0, z1): {bounds}')
+        x_0, x_1, y_0, y_1, z_0, z_1 = bounds
+        outfile = os.path.join(outdir, f'subcube_{idx}.fits')
+        sub_header = subcube_header(header, bounds)
+        fits.writeto(outfile, data[z_0:z_1, y_0:y_1, x_0:x_1], sub_header,
+                     overwrite=True)
+        write_header(sub_header, outfile)
+    if noise is not None:
+        write_noise_cube(os.path.join(outdir, f'noise_{idx}.fits'),
+                         sub_header, noise[z_0:z_1])
+    return outfile
+
+def subcube_header(header, bounds):
+    '''Returns the header of a subcube extracted from a data cube
 
-    cube = SpectralCube.read(infile)
-    sub_cube = cube.subcube(xlo=cidx[0]*u.deg, xhi=cidx[2]*u.deg,
-                            ylo=cidx[1]*u.deg, yhi=cidx[3]*u.deg)
-    sub_cube.write(f'interim/subcubes/subcube_{idx}.fits')
+    Parameters
+    ----------
+    header: astropy.io.fits.Header
+        Header of the data cube
+    bounds: tuple of int
+        Pixel bounds (x0, x1, y0, y1, z0, z1) of the subcube
+    Returns
+    -------
+    sub_header: astropy.io.fits.Header
+        Header with the axes lengths and reference pixels shifted to the subcube
+    '''
+    x0, x1, y0, y1, z0, z1 = bounds
+    sub_header = header.copy()
+    for axis, (lo, hi) in enumerate([(x0, x1), (y0, y1), (z0, z1)], start=1):
+        sub_header[f'NAXIS{axis}'] = hi - lo
+        sub_header[f'CRPIX{axis}'] = header[f'CRPIX{axis}'] - lo
+    return sub_header
+
+def split_subcubes(infile, coord_subcubes, indices, slab=16, noise=None):
+    '''Creates the fits files of several subcubes reading the data cube only
+    once, one slab of channels at a time
+
+    Parameters
+    ----------
+    infile: str
+        Input file name
+    coord_subcubes: array
+        Array containing coordinates of subcubes
+    indices: list of int
+        Indices of the subcubes to export
+    slab: int
+        Number of channels read from the data cube at once
+    noise: array
+        Noise of each channel of the data cube. When given, the noise cubes of
+        the subcubes are also written
+    '''
+    with fits.open(infile, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        data = hdul[0].data
+        bounds = {idx: pixel_bounds(coord_subcubes[idx], header, data.shape)
+                  for idx in indices}
+        streams = {}
+        for idx in indices:
+            print(f'Now exporting item {idx}: {bounds[idx]}')
+            outfile = f'interim/subcubes/subcube_{idx}.fits'
+            # StreamingHDU appends a new extension to existing files
+            if os.path.isfile(outfile):
+                os.remove(outfile)
+            sub_header = subcube_header(header, bounds[idx])
+            streams[idx] = fits.StreamingHDU(outfile, sub_header)
+            write_header(sub_header, outfile)
+        z_min = min(bound[4] for bound in bounds.values())
+        z_max = max(bound[5] for bound in bounds.values())
+        for k_0 in range(z_min, z_max, slab):
+            k_1 = min(k_0 + slab, z_max)
+            print(f'Reading channels {k_0} to {k_1}')
+            planes = np.asarray(data[k_0:k_1])
+            for idx in indices:
+                x_0, x_1, y_0, y_1, z_0, z_1 = bounds[idx]
+                if z_1 <= k_0 or z_0 >= k_1:
+                    continue
+                streams[idx].write(np.ascontiguousarray(
+                    planes[max(z_0, k_0)-k_0:min(z_1, k_1)-k_0,
+                           y_0:y_1, x_0:x_1]))
+        for stream in streams.values():
+            stream.close()
+    if noise is not None:
+        for idx in indices:
+            z_0, z_1 = bounds[idx][4:]
+            write_noise_cube(f'interim/subcubes/noise_{idx}.fits',
+                             subcube_header(header, bounds[idx]),
+                             noise[z_0:z_1], slab=slab)
 
 def main():
     '''Splits the data cube in several subcubes'''
     args = get_args()
-    idx = int(args.idx)
     infile = args.datacube
-    coord_subcubes = np.loadtxt(args.coord_file, skiprows=1, delimiter=',')
-    coord_subcubes = np.atleast_2d(coord_subcubes)
-    split_subcube(infile, coord_subcubes, idx)
+    coord_subcubes = read_coord_file(args.coord_file)
+    noise = None
+    if args.noise_file is not None:
+        noise = read_channel_noise(args.noise_file)
+    if args.batch:
+        if args.idx in (None, 'all'):
+            indices = list(range(len(coord_subcubes)))
+        else:
+            indices = [int(idx) for idx in args.idx.split(',')]
+        split_subcubes(infile, coord_subcubes, indices, slab=args.slab,
+                       noise=noise)
+    else:
+        split_subcube(infile, coord_subcubes, int(args.idx), noise=noise)
 
 
 if __name__ == '__main__':